@@ -1,55 +1,116 @@
-import glob
+import json
 import logging
 import os
-import subprocess
+import shutil
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import boto3
-import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, url_for
 import urllib.parse
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import batch
+import config
+import downloader
+import jobs
+import media_cache
+import metrics
+import result_cache
+import runner
+import storage
+import transcoder
+import workspace
 
 
 app = Flask(__name__)
+if config.PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=config.PROXY_HOPS)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+job_manager = jobs.JobManager()
+workspace.start_janitor()
+warmed = threading.Event()
+
+metrics.Gauge('spcut_job_queue_depth', 'Jobs waiting for a worker by priority class.', job_manager.queue.depths,
+              ('class',))
+metrics.Gauge('spcut_jobs', 'Known jobs by status.', job_manager.counts, ('status',))
+metrics.Gauge('spcut_encode_slots_active', 'Encoder slots in use.', lambda: jobs.encoder_slots.active)
+metrics.Gauge('spcut_encode_busy_seconds', 'Time at least one encode was running.', jobs.encoder_slots.busy_seconds)
+metrics.Gauge('spcut_result_cache_hits', 'Result cache hits.', lambda: result_cache.cache.hits)
+metrics.Gauge('spcut_result_cache_misses', 'Result cache misses.', lambda: result_cache.cache.misses)
+metrics.Gauge('spcut_media_cache_bytes', 'Bytes of source media cached locally.',
+              lambda: media_cache.cache.stats()['bytes'])
+metrics.Gauge('spcut_media_cache_hits', 'Media cache hits.', lambda: media_cache.cache.hits)
+metrics.Gauge('spcut_media_cache_misses', 'Media cache misses.', lambda: media_cache.cache.misses)
+metrics.Gauge('spcut_media_cache_evictions', 'Media cache evictions.', lambda: media_cache.cache.evictions)
+QUEUE_WAIT = metrics.Histogram('spcut_queue_wait_seconds', 'Time jobs spent queued before a worker took them.',
+                               labelnames=('class',))
+job_manager.queue.on_dispatch = lambda job, waited: QUEUE_WAIT.observe(waited, **{'class': job.priority})
+COALESCED = metrics.Counter('spcut_coalesced_requests_total', 'Requests attached to an identical job in flight.',
+                            ('kind',))
+submit_lock = threading.Lock()
+
+PROCESS_ARGS = '--cdist 19.24 --hfov 63.4 --hadjust 0.02 --primary right --hero right --projection rect --bitrate 200M --quality 1.0'
+MERGE_ARGS = '--cdist 19.24 --hfov 63.4 --hadjust 0.02 --projection rect --hero right --primary right'
+
+def warm():
+    # once per process before it takes traffic: the S3 client (endpoint resolution, service model,
+    # signer) and a check that the tools jobs shell out to are there
+    started = time.time()
+    storage.get_client().generate_presigned_url('get_object', Params={'Bucket': 'spcut-output', 'Key': 'warm'},
+                                                ExpiresIn=60)
+    missing = [tool for tool in ('ffmpeg', 'ffprobe') if shutil.which(tool) is None]
+    missing += [tool for tool in ('./spatial', './spatialmkt') if not os.path.exists(tool)]
+    if missing:
+        logger.warning(f"not found: {', '.join(missing)}")
+    warmed.set()
+    logger.info(f"warm in {time.time() - started:.2f}s")
+
+
+def drain():
+    return job_manager.drain(config.DRAIN_TIMEOUT)
+
+
 def download_video(url, save_path):
-    response = requests.get(url)
-    print(response.status_code)
-    if response.status_code == 200:
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
-        return True
-    else:
+    # through the local media cache; the cached copy stays pinned until the job finishes
+    try:
+        release = media_cache.cache.fetch(url, save_path)
+    except (downloader.DownloadError, OSError) as e:
+        logger.error(f"download failed: {url}: {e}")
         return False
+    jobs.defer(release)
+    return True
 
 def process_video(inp, out):
-    out = 'output_' + out
+    out = os.path.join(os.path.dirname(out), 'output_' + os.path.basename(out))
+    s3_key = os.path.basename(out)
     commands = [
         # './spatial make -i {0} -f ou -o {1} --cdist 19.24 --hfov 63.4 --hadjust 0.02 --primary right --projection rect'.format(inp, out),
         # spatial make -i {inupt_file} -f ou -o {output_file} --cdist 19.24 --hfov 63.4 --hadjust 0.02 --primary right
-        './spatial make -i {0} -f ou -o {1} --cdist 19.24 --hfov 63.4 --hadjust 0.02 --primary right --hero right --projection rect --bitrate 200M --quality 1.0'.format(inp, out)
+        './spatial make -i {0} -f ou -o {1} {2}'.format(inp, out, PROCESS_ARGS)
     ]
     for command in commands:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Running command: {}'.format(command))
-        stdout, stderr = process.communicate(input='y\n')
-        print('Output: {}'.format(stdout))
+        with jobs.encoder_slots.acquire('encode'), metrics.stage('spatial_make') as stage:
+            logger.info(f"Running command: {command}")
+            process = runner.run(command, shell=True, input='y\n')
+            stage.add_child(process)
+            stage.failed = process.returncode != 0
+            stage.bytes = os.path.getsize(inp)
         if process.returncode != 0:
-            print('Error: {}'.format(stderr))
+            logger.error(f"spatial make failed ({process.returncode}): {process.output}")
             return False, ''
 
-    s3 = boto3.client('s3')
+    jobs.set_stage('upload')
     try:
-        with open(out, 'rb') as data:
-            s3.upload_fileobj(data, "spcut-output", out)
+        storage.upload_file(out, "spcut-output", s3_key)
     except Exception as e:
         print(f"Error uploading file to S3: {e}")
         return False, ''
 
     try:
-        presigned_url = s3.generate_presigned_url('get_object', Params={'Bucket': "spcut-output", 'Key': out}, ExpiresIn=3600*24)
+        presigned_url = storage.presign("spcut-output", s3_key, 3600*24)
     except Exception as e:
         print(f"Error generating pre-signed URL: {e}")
         return False, None
@@ -64,12 +125,10 @@ def process_video_ffmpeg(input_file, output_file):
     command = f'ffmpeg -i {input_file} -c:v libx265 -preset ultrafast -crf 18 -vf "format=yuv420p" -profile:v main -level 5.1 -tag:v hvc1 -metadata:s:v creation_time="2024-06-02T23:01:07.000000Z" -metadata:s:v handler_name="Core Media Video" -metadata:s:v vendor_id="[0][0][0][0]" -metadata:s:a handler_name="Core Media Audio" -metadata:s:a language=und -metadata major_brand=qt -metadata minor_version=0 -metadata compatible_brands=qt -metadata com.apple.quicktime.location.accuracy.horizontal="35.000000" -metadata com.apple.quicktime.spatial.format-version="1.0" -metadata com.apple.quicktime.spatial.aggressors-seen="0" -metadata com.apple.quicktime.location.ISO6709="+37.5639-122.3252+012.168/" -metadata com.apple.quicktime.make="Apple" -metadata com.apple.quicktime.model="iPhone 15 Pro Max" -metadata com.apple.quicktime.software="17.5.1" -metadata com.apple.quicktime.creationdate="2024-06-02T16:01:07-0700" -c:a aac -b:a 320k -map 0 -movflags +faststart {output_file}'
     
     logger.info(f"Executing command: {command}")
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    
-    stdout, stderr = process.communicate()
+    process = runner.run(command, shell=True)
     
     if process.returncode != 0:
-        logger.error(f"FFmpeg processing failed: {stderr}")
+        logger.error(f"FFmpeg processing failed: {process.output}")
         return False
     
     logger.info("FFmpeg processing completed successfully")
@@ -81,39 +140,35 @@ def split_video(inp):
     command = f'./spatial export -i {inp}.MOV -o {inp}_LEFT.mov -o {inp}_RIGHT.mov'
     
     logger.info(f"Executing command: {command}")
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    
-    stdout, stderr = process.communicate()
+    with jobs.encoder_slots.acquire('split'), metrics.stage('spatial_export') as stage:
+        process = runner.run(command, shell=True)
+        stage.add_child(process)
+        stage.failed = process.returncode != 0
+        stage.bytes = os.path.getsize(f'{inp}.MOV')
     
     if process.returncode != 0:
         logger.error(f"Split failed with code: {process.returncode}")
-        logger.error(f"Error: {stderr}")
+        logger.error(f"Error: {process.output}")
         return False, {}
     
     logger.info("Split completed successfully")
     
-    s3_client = boto3.client('s3')
     bucket_name = 'spcut-split'
     result = {}
 
+    jobs.set_stage('upload')
     logger.info("Uploading to S3")
-    for suffix in ['LEFT', 'RIGHT']:
-        output_file = f'{inp}_{suffix}.mov'
-        
+    output_files = [f'{inp}_{suffix}.mov' for suffix in ['LEFT', 'RIGHT']]
+    for output_file in output_files:
         if not os.path.exists(output_file):
             logger.error(f"File not found: {output_file}")
             return False, {}
-        
-        s3_key = output_file
-        
-        logger.info(f"Uploading split file to S3: {output_file}")
-        s3_client.upload_file(output_file, bucket_name, s3_key)
-        
-        url = s3_client.generate_presigned_url('get_object',
-                                                Params={'Bucket': bucket_name,
-                                                        'Key': s3_key},
-                                                ExpiresIn=3600)
-        result[suffix.lower()] = url
+
+    logger.info(f"Uploading split files to S3: {output_files}")
+    storage.upload_files([(output_file, bucket_name, os.path.basename(output_file)) for output_file in output_files])
+
+    for suffix, output_file in zip(['LEFT', 'RIGHT'], output_files):
+        result[suffix.lower()] = storage.presign(bucket_name, os.path.basename(output_file), 3600)
         logger.info(f"Generated presigned URL for {suffix}")
 
         os.remove(output_file)
@@ -121,32 +176,112 @@ def split_video(inp):
     logger.info("Split and upload completed successfully")
     return True, result
 
-def merge_videos(left_file, right_file, output_file, bitrate='20M', quality='0.5'):
-    logger.info(f"merging: {left_file} and {right_file}")
+# ./spatial sets its own threads, so a chunk slot is one process rather than a share of the cores
+chunk_engine = transcoder.TranscodeEngine(config.MERGE_CHUNK_PARALLEL or jobs.encoder_slots.slots, 1)
 
-    command = f'./spatial make -i {right_file} -i {left_file} --cdist 19.24 --hfov 63.4 --hadjust 0.02 --projection rect --hero right --primary right --bitrate {bitrate} --quality {quality} -o {output_file}'
-    logger.info(f"executing command: {command}")
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    stdout, stderr = process.communicate()
 
+def make_chunk(right_file, left_file, output_file, bitrate, quality):
+    command = f'./spatial make -i {right_file} -i {left_file} {MERGE_ARGS} --bitrate {bitrate} --quality {quality} -o {output_file}'
+    with metrics.stage('spatial_make_chunk') as stage:
+        process = runner.run(command, shell=True)
+        stage.add_child(process)
+        stage.failed = process.returncode != 0
+        stage.bytes = os.path.getsize(left_file) + os.path.getsize(right_file)
     if process.returncode != 0:
+        logger.error(f"chunk merge failed ({process.returncode}): {process.output}")
+        return False
+    return True
+
+
+def merge_chunked(left_file, right_file, output_file, bitrate, quality):
+    # time-aligned chunk pairs merged in parallel and joined; False means use a single pass instead
+    jobs.set_stage('encode')
+    workdir = output_file + '_chunks'
+    os.makedirs(workdir, exist_ok=True)
+    joined = False
+    try:
+        cuts = transcoder.common_cuts(transcoder.keyframe_times(left_file), transcoder.keyframe_times(right_file),
+                                      config.MERGE_CHUNK_SECONDS)
+        if not cuts:
+            logger.info("no shared keyframes to cut at, merging in one pass")
+            return False
+        lefts = transcoder.split_at(left_file, cuts, os.path.join(workdir, 'left_%05d.mov'))
+        rights = transcoder.split_at(right_file, cuts, os.path.join(workdir, 'right_%05d.mov'))
+        if len(lefts) != len(rights):
+            logger.warning(f"eyes cut into {len(lefts)} and {len(rights)} chunks, merging in one pass")
+            return False
+
+        calls = [(right, left, os.path.join(workdir, f'merged_{i:05d}.mov'), bitrate, quality)
+                 for i, (left, right) in enumerate(zip(lefts, rights))]
+        job = jobs.current_job()
+        futures = chunk_engine.submit(job.id if job else output_file, jobs.bind(make_chunk), calls)
+        try:
+            if not all([future.result() for future in futures]):
+                return False
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            # chunks already running still write into workdir
+            wait(futures)
+            raise
+
+        transcoder.concat([call[2] for call in calls], right_file, output_file)
+        expected, actual = transcoder.stream_stats(right_file), transcoder.stream_stats(output_file)
+        if not transcoder.same_timeline(expected, actual):
+            logger.error(f"chunked merge does not match the source ({actual} vs {expected}), merging in one pass")
+            return False
+        # frame counts can't show a dropped second view or stereo metadata, the sample entry can
+        chunk, whole = transcoder.sample_entry(calls[0][2]), transcoder.sample_entry(output_file)
+        if chunk is None or whole is None or chunk[0] != whole[0] or set(chunk[1]) - set(whole[1]):
+            logger.error(f"chunked merge lost sample entry boxes ({whole} vs {chunk}), merging in one pass")
+            return False
+        jobs.record('merge_chunks', len(calls))
+        logger.info(f"merged in {len(calls)} chunks: {actual['frames']} frames, {actual['duration']:.2f}s")
+        joined = True
+        return True
+    except transcoder.TranscodeError as e:
+        logger.warning(f"chunked merge failed, merging in one pass: {e}")
+        return False
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        # ./spatial would stop at its overwrite prompt on a rejected output left behind
+        if not joined and os.path.exists(output_file):
+            os.remove(output_file)
+
+
+def merge_videos(left_file, right_file, output_file, bitrate='20M', quality='0.5'):
+    logger.info(f"merging: {left_file} and {right_file}")
+
+    command = f'./spatial make -i {right_file} -i {left_file} {MERGE_ARGS} --bitrate {bitrate} --quality {quality} -o {output_file}'
+    # the chunks are bounded by chunk_engine, so only the single pass takes an encode slot
+    chunked = config.MERGE_CHUNK_SECONDS and merge_chunked(left_file, right_file, output_file, bitrate, quality)
+    if not chunked:
+        with jobs.encoder_slots.acquire('encode'):
+            logger.info(f"executing command: {command}")
+            with metrics.stage('spatial_make') as stage:
+                process = runner.run(command, shell=True)
+                stage.add_child(process)
+                stage.failed = process.returncode != 0
+                stage.bytes = os.path.getsize(left_file) + os.path.getsize(right_file)
+
+    if not chunked and process.returncode != 0:
         logger.error(f"merge failed: {process.returncode}")
-        logger.error(f"err: {stderr}")
-        return False, stderr
+        logger.error(f"err: {process.output}")
+        return False, process.output
 
     logger.info("merge done")
 
     # Upload the merged video directly to S3
-    s3 = boto3.client('s3')
+    jobs.set_stage('upload')
+    s3_key = os.path.basename(output_file)
     try:
-        with open(output_file, 'rb') as data:
-            s3.upload_fileobj(data, "spcut-output", output_file)
+        storage.upload_file(output_file, "spcut-output", s3_key)
     except Exception as e:
         logger.error(f"Error uploading file to S3: {e}")
         return False, ''
 
     try:
-        presigned_url = s3.generate_presigned_url('get_object', Params={'Bucket': "spcut-output", 'Key': output_file}, ExpiresIn=3600*24)
+        presigned_url = storage.presign("spcut-output", s3_key, 3600*24)
     except Exception as e:
         logger.error(f"Error generating pre-signed URL: {e}")
         return False, None
@@ -167,22 +302,15 @@ def cleanup(inp):
     else:
         logger.warning(f"delete: not found: {input_file}")
 
+    # only this job's eyes; a glob here would delete files of concurrent jobs
     for suffix in ['LEFT', 'RIGHT']:
-        pattern = f"*{suffix}.mov"
-        matching_files = glob.glob(pattern)
-        
-        if not matching_files:
-            logger.warning(f"no files found with: {pattern}")
-        
-        for file in matching_files:
-            if os.path.exists(file):
-                try:
-                    os.remove(file)
-                    logger.info(f"deleted: {file}")
-                except Exception as e:
-                    logger.error(f"Failed to delete file {file}: {str(e)}")
-            else:
-                logger.warning(f"File not found: {file}")
+        file = f"{inp}_{suffix}.mov"
+        if os.path.exists(file):
+            try:
+                os.remove(file)
+                logger.info(f"deleted: {file}")
+            except Exception as e:
+                logger.error(f"Failed to delete file {file}: {str(e)}")
 
     logger.info("cleanup done")
     
@@ -201,25 +329,289 @@ def cleanup_merged(file):
     logger.info("cleanup post-merge")
 
 
+def get_filename_from_url(url):
+    parsed_url = urllib.parse.urlparse(url)
+    path = urllib.parse.unquote(parsed_url.path)
+    return os.path.basename(path)
+
+
+def download_inputs(downloads):
+    # fetch all inputs of a job concurrently; download_overlapped_encode_seconds is how much of
+    # the download ran while other jobs held the encoder
+    jobs.set_stage('download')
+    busy_before = jobs.encoder_slots.busy_seconds()
+    started = time.time()
+
+    def timed_download(item):
+        t = time.time()
+        ok = download_video(*item)
+        return ok, time.time() - t
+
+    with ThreadPoolExecutor(max_workers=len(downloads)) as pool:
+        results = list(pool.map(jobs.bind(timed_download), downloads))
+
+    wall = time.time() - started
+    serial = sum(seconds for _, seconds in results)
+    jobs.record('download_seconds', wall)
+    jobs.record('download_saved_seconds', max(0.0, serial - wall))
+    jobs.record('download_overlapped_encode_seconds', jobs.encoder_slots.busy_seconds() - busy_before)
+    return all(ok for ok, _ in results)
+
+
+def check_cache(endpoint, sources, args, files=False):
+    # sources are URLs (identified by ETag/length) or, once downloaded, local files (by content hash)
+    jobs.set_stage('cache')
+    identify = result_cache.file_identity if files else result_cache.url_identity
+    identities = [identify(source) for source in sources]
+    if not all(identities):
+        return None, None
+    key = result_cache.make_key(endpoint, identities, args)
+    try:
+        cached = result_cache.cache.lookup(key)
+    except Exception as e:
+        logger.error(f"cache lookup failed: {e}")
+        return key, None
+    jobs.record('cache', 'hit' if cached else 'miss')
+    return key, cached
+
+
+def cache_result(key, outputs, expires):
+    try:
+        result_cache.cache.store(key, outputs, expires)
+    except Exception as e:
+        logger.error(f"cache store failed: {e}")
+
+
+def publish_preview(ws, inputs):
+    # runs beside the full encode; a failure only costs the preview
+    name = f'preview_{jobs.current_job().id}.mp4'
+    output_file = ws.path(name)
+    try:
+        transcoder.preview(inputs, output_file)
+        storage.upload_file(output_file, "spcut-output", name)
+        url = storage.presign("spcut-output", name, 3600*24)
+    except Exception as e:
+        logger.error(f"preview failed: {e}")
+        return
+    finally:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+    jobs.set_preview(url)
+    logger.info(f"preview published: {name}")
+
+
+def run_process(ws, video_url, preview=False):
+    video_name = ws.path(video_url.split('/')[-1])
+    output_file = ws.path(os.path.basename(video_name).split('.')[0] + '_done.mov')
+
+    cache_key, cached = check_cache('process', [video_url], PROCESS_ARGS)
+    if cached:
+        return cached
+
+    if not download_inputs([(video_url, video_name)]):
+        raise jobs.JobFailed('Failed to download video')
+
+    if cache_key is None:
+        cache_key, cached = check_cache('process', [video_name], PROCESS_ARGS, files=True)
+        if cached:
+            return cached
+
+    # leaving the pool waits for the preview, so the input outlives it
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        if preview:
+            pool.submit(jobs.bind(publish_preview), ws, [video_name])
+        success, url = process_video(video_name, output_file)
+    if not success:
+        raise jobs.JobFailed('Failed to process video')
+    cache_result(cache_key, {'output': ('spcut-output', 'output_' + os.path.basename(output_file))}, 3600*24)
+    return {'output': url}
+
+
+def run_split(ws, video_url):
+    video_name = ws.path(video_url.split('/')[-1].split('.')[0])
+
+    cache_key, cached = check_cache('split', [video_url], 'export')
+    if cached:
+        return cached
+
+    if not download_inputs([(video_url, video_name + '.MOV')]):
+        raise jobs.JobFailed('Failed to download video')
+
+    if cache_key is None:
+        cache_key, cached = check_cache('split', [video_name + '.MOV'], 'export', files=True)
+        if cached:
+            cleanup(video_name)
+            return cached
+
+    success, response = split_video(video_name)
+    if not success:
+        raise jobs.JobFailed('Failed to split video')
+    cleanup(video_name)
+    split_keys = {suffix.lower(): ('spcut-split', f'{os.path.basename(video_name)}_{suffix}.mov') for suffix in ['LEFT', 'RIGHT']}
+    cache_result(cache_key, split_keys, 3600)
+    return response
+
+
+def run_merge(ws, left_url, right_url, uid, bitrate, quality, preview=False):
+    left_file = ws.path('left_' + get_filename_from_url(left_url))
+    right_file = ws.path('right_' + get_filename_from_url(right_url))
+    output_file = ws.path(f"{uid}_{int(time.time())}.mov")
+    cache_args = f'{MERGE_ARGS} --bitrate {bitrate} --quality {quality}'
+
+    cache_key, cached = check_cache('merge', [left_url, right_url], cache_args)
+    if cached:
+        return cached
+
+    try:
+        if not download_inputs([(left_url, left_file), (right_url, right_file)]):
+            raise jobs.JobFailed('Failed to download one or both videos')
+
+        if cache_key is None:
+            cache_key, cached = check_cache('merge', [left_file, right_file], cache_args, files=True)
+            if cached:
+                return cached
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            if preview:
+                pool.submit(jobs.bind(publish_preview), ws, [left_file, right_file])
+            success, result = merge_videos(left_file, right_file, output_file, bitrate, quality)
+        if not success:
+            raise jobs.JobFailed(f'Failed to merge videos: {result}')
+        cache_result(cache_key, {'output': ('spcut-output', os.path.basename(output_file))}, 3600*24)
+        return {'output': result}
+    finally:
+        cleanup_merged(left_file)
+        cleanup_merged(right_file)
+        cleanup_merged(output_file)
+
+
+def run_merge_item(merge_batch, index, left_url, right_url, uid, bitrate, quality):
+    # one item of a /merge/batch; sources come from the batch's shared downloads
+    output_file = merge_batch.ws.path(f"{uid}_{int(time.time())}_{index}.mov")
+    cache_args = f'{MERGE_ARGS} --bitrate {bitrate} --quality {quality}'
+    jobs.record('batch', merge_batch.id)
+
+    try:
+        cache_key, cached = check_cache('merge', [left_url, right_url], cache_args)
+        if cached:
+            return cached
+
+        jobs.set_stage('download')
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            left_file, right_file = pool.map(jobs.bind(merge_batch.fetch), [left_url, right_url])
+        jobs.record('download_seconds', time.time() - started)
+        if not left_file or not right_file:
+            raise jobs.JobFailed('Failed to download one or both videos')
+
+        if cache_key is None:
+            cache_key, cached = check_cache('merge', [left_file, right_file], cache_args, files=True)
+            if cached:
+                return cached
+
+        success, result = merge_videos(left_file, right_file, output_file, bitrate, quality)
+        if not success:
+            raise jobs.JobFailed(f'Failed to merge videos: {result}')
+        cache_result(cache_key, {'output': ('spcut-output', os.path.basename(output_file))}, 3600*24)
+        return {'output': result}
+    finally:
+        merge_batch.release(left_url)
+        merge_batch.release(right_url)
+        if os.path.exists(output_file):
+            cleanup_merged(output_file)
+
+
+def run_in_workspace(func, ws, *args):
+    jobs.record('workspace', ws.dir)
+    return func(ws, *args)
+
+
+def probe_input(url):
+    try:
+        return downloader.probe(url)
+    except downloader.DownloadError:
+        return None
+
+
+def probe_inputs(urls):
+    with ThreadPoolExecutor(max_workers=min(8, len(urls))) as pool:
+        return list(pool.map(probe_input, urls))
+
+
+def input_size(infos):
+    sizes = [info['size'] if info else None for info in infos]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+
+def flight_key(kind, urls, infos, args):
+    # same inputs (by content where the origin says, else by URL) and same parameters = same request
+    identities = [(info and result_cache.info_identity(info)) or f'url:{url}' for url, info in zip(urls, infos)]
+    return result_cache.make_key(kind, identities, list(args))
+
+
+def scheduling(data, default_priority='interactive'):
+    # who the work is charged to for fair sharing, and its class; uid when given, else the caller's
+    # address (the client's, not a proxy's, when SPCUT_PROXY_HOPS is set)
+    owner = data.get('uid') or request.remote_addr
+    priority = data.get('priority', default_priority)
+    if priority not in config.PRIORITY_WEIGHTS:
+        return owner, priority, f"priority must be one of {', '.join(config.PRIORITY_WEIGHTS)}"
+    return owner, priority, None
+
+
+def job_cost(size):
+    # scheduler cost in MB of input; unknown sizes count as the admission default
+    return max(1.0, (size or config.WORKSPACE_DEFAULT_INPUT_BYTES) / config.MB)
+
+
+def submit_job(kind, func, urls, *args, owner=None, priority='interactive'):
+    infos = probe_inputs(urls)
+    size = input_size(infos)
+    key = flight_key(kind, urls, infos, args)
+
+    # held from the in-flight check to the submit so two identical requests can't both start
+    with submit_lock:
+        job = job_manager.attach(key)
+        if job is not None:
+            COALESCED.inc(kind=kind)
+            return jsonify({'job_id': job.id, 'status_url': url_for('jobStatus', job_id=job.id),
+                            'events_url': url_for('jobEvents', job_id=job.id), 'coalesced': True}), 202
+        if job_manager.draining.is_set():
+            return jsonify({'error': 'Server is shutting down, try again'}), 503, {'Retry-After': '30'}
+
+        try:
+            ws = workspace.admit(kind, size)
+        except workspace.InsufficientSpace as e:
+            logger.warning(f"rejecting {kind} job: {e}")
+            return jsonify({'error': 'Not enough scratch space for this job, try again later'}), 507, {'Retry-After': '60'}
+
+        try:
+            # closed on finish rather than inside the job, so a job cancelled while queued still frees it
+            job = job_manager.submit(kind, run_in_workspace, func, ws, *urls, *args, on_finish=lambda job: ws.close(),
+                                     owner=owner, priority=priority, cost=job_cost(size), key=key)
+        except jobs.QueueFull:
+            ws.close()
+            return jsonify({'error': 'Too many jobs queued, try again later'}), 429, {'Retry-After': '30'}
+    return jsonify({'job_id': job.id, 'status_url': url_for('jobStatus', job_id=job.id),
+                    'events_url': url_for('jobEvents', job_id=job.id)}), 202
+
+
 @app.route('/process', methods=['POST'])
 def processVideo():
     data = request.json
     video_url = data.get('url')
     if not video_url:
         return jsonify({'error': 'URL not provided'}), 400
-
-    video_name = video_url.split('/')[-1]
-    output_file = video_name.split('.')[0] + '_done.mov'
-
-    success = download_video(video_url, video_name)
-    if success:
-        success, url = process_video(video_name, output_file)
-        if not success:
-            return jsonify({'error': 'Failed to process video'}), 500
-        # cleanup(video_name)
-        return jsonify({'output': url}), 200
-    else:
-        return jsonify({'error': 'Failed to download video'}), 500
+    owner, priority, error = scheduling(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # with preview set, a short low-resolution clip is published on the job (and as a 'preview'
+    # event) while the full encode runs
+    return submit_job('process', run_process, [video_url], bool(data.get('preview')), owner=owner,
+                      priority=priority)
     
 
 @app.route('/split', methods=['POST'])
@@ -228,61 +620,201 @@ def splitVideo():
     video_url = data.get('url')
     if not video_url:
         return jsonify({'error': 'URL not provided'}), 400
+    owner, priority, error = scheduling(data)
+    if error:
+        return jsonify({'error': error}), 400
 
-    video_name = video_url.split('/')[-1].split('.')[0]
-
-    success = download_video(video_url, video_name + '.MOV')
-    if success:
-        success, response = split_video(video_name)
-        if not success:
-            return jsonify({'error': 'Failed to split video'}), 500
-        cleanup(video_name + '.MOV')
-        return jsonify(response), 200
-    else:
-        return jsonify({'error': 'Failed to download video'}), 500
-    
-    
-@app.route('/merge', methods=['POST'])
-def mergeVideos():
-    data = request.json
-    uid = data.get('uid')
-    left_url = data.get('left_url')
-    right_url = data.get('right_url')
-    bitrate = data.get('bitrate')
-    quality = data.get('quality', 0.5)
-    
-    if quality is not None and quality > 1:
-        return jsonify({'error': 'Quality can not be greater than 1.0'}), 400
+    return submit_job('split', run_split, [video_url], owner=owner, priority=priority)
     
-    if not left_url or not right_url:
-        return jsonify({'error': 'Both left and right video URLs are required'}), 400
     
-    def get_filename_from_url(url):
-        parsed_url = urllib.parse.urlparse(url)
-        path = urllib.parse.unquote(parsed_url.path)
-        return os.path.basename(path)
-
-    left_file = 'left_' + get_filename_from_url(left_url)
-    right_file = 'right_' + get_filename_from_url(right_url)
-    output_file = f"{uid}_{int(time.time())}.mov"
-
-    if download_video(left_url, left_file) and download_video(right_url, right_file):
-        success, result = merge_videos(left_file, right_file, output_file, bitrate, quality)
-        
-        cleanup_merged(left_file)
-        cleanup_merged(right_file)
-        cleanup_merged(output_file) 
-        
-        if success:
-            return jsonify({'output': result}), 200
-        else:
-            return jsonify({'error': f'Failed to merge videos: {result}'}), 500
-    else:
-        return jsonify({'error': 'Failed to download one or both videos'}), 500
+def merge_item(data):
+    item = {
+        'uid': data.get('uid'),
+        'left_url': data.get('left_url'),
+        'right_url': data.get('right_url'),
+        'bitrate': data.get('bitrate'),
+        'quality': data.get('quality', 0.5),
+    }
+    if item['quality'] is not None and item['quality'] > 1:
+        return None, 'Quality can not be greater than 1.0'
+    if not item['left_url'] or not item['right_url']:
+        return None, 'Both left and right video URLs are required'
+    return item, None
 
-@app.route('/', methods=['GET'])
-def test():
-    return jsonify({'message': 'Hello World!'})
 
+@app.route('/merge', methods=['POST'])
+def mergeVideos():
+    item, error = merge_item(request.json)
+    if error:
+        return jsonify({'error': error}), 400
+    owner, priority, error = scheduling(request.json)
+    if error:
+        return jsonify({'error': error}), 400
+
+    return submit_job('merge', run_merge, [item['left_url'], item['right_url']], item['uid'], item['bitrate'],
+                      item['quality'], bool(request.json.get('preview')), owner=owner, priority=priority)
+
+
+@app.route('/merge/batch', methods=['POST'])
+def mergeBatch():
+    entries = (request.json or {}).get('items')
+    if not entries or not isinstance(entries, list):
+        return jsonify({'error': 'items not provided'}), 400
+    # batches default to the bulk class so they don't hold up interactive requests
+    owner, priority, error = scheduling(request.json, 'bulk')
+    if error:
+        return jsonify({'error': error}), 400
+    if len(entries) > job_manager.queue.maxsize:
+        return jsonify({'error': f'At most {job_manager.queue.maxsize} items per batch'}), 400
+    if job_manager.draining.is_set():
+        return jsonify({'error': 'Server is shutting down, try again'}), 503, {'Retry-After': '30'}
+
+    items = []
+    for index, data in enumerate(entries):
+        item, error = merge_item(data)
+        if error:
+            return jsonify({'error': f'item {index}: {error}'}), 400
+        items.append(item)
+
+    # every distinct source is downloaded once, so that is what the workspace has to hold
+    urls = list(dict.fromkeys(url for item in items for url in (item['left_url'], item['right_url'])))
+    size = input_size(probe_inputs(urls))
+    try:
+        ws = workspace.admit('merge', size)
+    except workspace.InsufficientSpace as e:
+        logger.warning(f"rejecting merge batch: {e}")
+        return jsonify({'error': 'Not enough scratch space for this batch, try again later'}), 507, {'Retry-After': '60'}
+    merge_batch = batch.Batch(ws, items, download_video)
+
+    calls = [(run_merge_item, (merge_batch, index, item['left_url'], item['right_url'], item['uid'], item['bitrate'],
+                               item['quality']), item['uid'] or owner) for index, item in enumerate(items)]
+    # held so no item can report back before the batch knows its jobs
+    with merge_batch.cond:
+        try:
+            merge_batch.jobs = job_manager.submit_many('merge', calls, on_finish=merge_batch.item_finished,
+                                                       priority=priority, cost=job_cost(size) / len(items))
+        except jobs.QueueFull:
+            ws.close()
+            return jsonify({'error': 'Too many jobs queued, try again later'}), 429, {'Retry-After': '30'}
+    batch.register(merge_batch)
+    logger.info(f"batch {merge_batch.id}: {len(items)} merges, {len(urls)} distinct sources")
+
+    return jsonify({
+        'batch_id': merge_batch.id,
+        'status_url': url_for('batchStatus', batch_id=merge_batch.id),
+        'results_url': url_for('batchResults', batch_id=merge_batch.id),
+        'items': [{'uid': item['uid'], 'job_id': job.id} for item, job in zip(items, merge_batch.jobs)],
+    }), 202
+
+
+@app.route('/batches/<batch_id>', methods=['GET'])
+def batchStatus(batch_id):
+    merge_batch = batch.get(batch_id)
+    if merge_batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    merge_batch.touch()
+    return jsonify(merge_batch.to_dict()), 200
+
+
+@app.route('/batches/<batch_id>', methods=['DELETE'])
+def cancelBatch(batch_id):
+    merge_batch = batch.get(batch_id)
+    if merge_batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+    return jsonify({'batch_id': merge_batch.id, 'cancelled': merge_batch.cancel('batch cancelled by client')}), 202
+
+
+@app.route('/batches/<batch_id>/results', methods=['GET'])
+def batchResults(batch_id):
+    # one JSON line per item, written as each finishes
+    merge_batch = batch.get(batch_id)
+    if merge_batch is None:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    def stream():
+        sent = set()
+        while len(sent) < len(merge_batch.items):
+            merge_batch.touch()
+            merge_batch.wait(len(sent), timeout=15)
+            ready = [i for i in merge_batch.finished_items() if i not in sent]
+            if not ready:
+                yield '\n'  # keepalive
+            for index in ready:
+                sent.add(index)
+                yield json.dumps(merge_batch.item_dict(index)) + '\n'
+
+    return Response(stream(), mimetype='application/x-ndjson')
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def jobStatus(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    job.touch()
+    return jsonify(job.to_dict()), 200
+
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancelJob(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if job_manager.detach(job):
+        return jsonify({'job_id': job.id, 'status': 'detached'}), 202
+    if not job.cancel('cancelled by client'):
+        return jsonify({'error': 'Job already finished', 'status': job.status}), 409
+    return jsonify({'job_id': job.id, 'status': 'cancelling'}), 202
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def jobEvents(job_id):
+    # Server-Sent Events: stage changes and progress while the job runs, then one final status event
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    last = int(request.headers.get('Last-Event-ID') or 0)
+
+    def stream():
+        nonlocal last
+        while True:
+            job.touch()
+            events = job.events_since(last, timeout=15)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for seq, event, data in events:
+                last = seq
+                yield f'id: {seq}\nevent: {event}\ndata: {json.dumps(data)}\n\n'
+                if event == 'status':
+                    return
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/metrics', methods=['GET'])
+def prometheusMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({'uploads': storage.stats(), 'result_cache': result_cache.cache.stats(),
+                    'media_cache': media_cache.cache.stats(),
+                    'queue': {p: n for (p,), n in job_manager.queue.depths().items()}}), 200
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # liveness: the job workers and watchdog are still running
+    if not job_manager.alive():
+        return jsonify({'status': 'job threads died'}), 500
+    return jsonify({'status': 'ok'}), 200
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # readiness: warmed up and not draining
+    ready = warmed.is_set() and not job_manager.draining.is_set()
+    return jsonify({'ready': ready, 'warmed': warmed.is_set(), 'draining': job_manager.draining.is_set(),
+                    'queued': job_manager.queue.qsize(), 'active': job_manager.active()}), 200 if ready else 503
+
+# development only; production runs server.py
 if __name__ == '__main__':
+    warm()
     app.run(debug=True, port=80, host='0.0.0.0')
\ No newline at end of file
@@ -1,29 +1,35 @@
-import glob
 import logging
-import multiprocessing
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import urllib.parse
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
+
+import config
+import downloader
+import jobs
+import metrics
+import storage
+import transcoder
+import workspace
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 def download_video(url, save_path):
-    response = requests.get(url)
-    print(response.status_code)
-    if response.status_code == 200:
-        with open(save_path, 'wb') as f:
-            f.write(response.content)
-        return True
-    else:
+    try:
+        downloader.download(url, save_path)
+    except (downloader.DownloadError, OSError) as e:
+        logger.error(f"download failed: {url}: {e}")
         return False
+    return True
 
 def process_video(inp, out):
     out = 'output_' + out
@@ -33,24 +39,26 @@ def process_video(inp, out):
         './spatial make -i {0} -f ou -o {1} --cdist 19.24 --hfov 63.4 --hadjust 0.02 --primary right --projection rect'.format(inp, out)
     ]
     for command in commands:
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        print('Running command: {}'.format(command))
-        stdout, stderr = process.communicate(input='y\n')
+        with metrics.stage('spatial_make') as stage:
+            process = metrics.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            print('Running command: {}'.format(command))
+            stdout, stderr = process.communicate(input='y\n')
+            stage.add_child(process)
+            stage.failed = process.returncode != 0
+            stage.bytes = os.path.getsize(inp)
         print('Output: {}'.format(stdout))
         if process.returncode != 0:
             print('Error: {}'.format(stderr))
             return False, ''
 
-    s3 = boto3.client('s3')
     try:
-        with open(out, 'rb') as data:
-            s3.upload_fileobj(data, "spcut-output", out)
+        storage.upload_file(out, "spcut-output", out)
     except Exception as e:
         print(f"Error uploading file to S3: {e}")
         return False, ''
 
     try:
-        presigned_url = s3.generate_presigned_url('get_object', Params={'Bucket': "spcut-output", 'Key': out}, ExpiresIn=3600*24)
+        presigned_url = storage.presign("spcut-output", out, 3600*24)
     except Exception as e:
         print(f"Error generating pre-signed URL: {e}")
         return False, None
@@ -59,48 +67,46 @@ def process_video(inp, out):
 
     return True, presigned_url
 
-def process_video_ffmpeg(input_file, output_file):
+def process_video_ffmpeg(input_file, output_file, owner=None):
     logger.info(f"Processing video with FFmpeg: {input_file}")
 
     request_id = str(uuid.uuid4())
-    segment_pattern = f"segment_{request_id}_%03d.ts"
+    started = time.time()
+    try:
+        timings = transcoder.transcode(input_file, output_file, request_id, owner=owner)
+    except transcoder.TranscodeError as e:
+        logger.error(f"FFmpeg processing failed for {input_file}: {e}")
+        return False
 
-    segment_duration = "10"
-    split_command = f'ffmpeg -i {input_file} -c copy -f segment -segment_time {segment_duration} -reset_timestamps 1 {segment_pattern}'
-    subprocess.run(split_command, shell=True, check=True)
+    encode_seconds = sum(t['seconds'] for t in timings)
+    logger.info(f"FFmpeg processing completed successfully: {len(timings)} segments, "
+                f"{encode_seconds:.1f}s encode time in {time.time() - started:.1f}s wall")
+    return True
 
-    segment_files = sorted(glob.glob(f"segment_{request_id}_*.ts"))
-    pool = multiprocessing.Pool()
-    processed_segments = pool.map(process_segment, [(file, request_id) for file in segment_files])
-    pool.close()
-    pool.join()
 
-    concat_input = '|'.join(processed_segments)
-    concat_command = f'ffmpeg -i "concat:{concat_input}" -c copy {output_file}'
-    subprocess.run(concat_command, shell=True, check=True)
+def process_and_upload_eye(inp, suffix, bucket_name):
+    input_file = f'{inp}_{suffix}.mov'
+    output_file = f'{inp}_{suffix}_processed.mov'
 
-    for file in segment_files + processed_segments:
-        os.remove(file)
+    if not os.path.exists(input_file):
+        logger.error(f"not found: {input_file}")
+        return None
 
-    logger.info("FFmpeg processing completed successfully")
-    return True
+    if not process_video_ffmpeg(input_file, output_file, owner=inp):
+        logger.error(f"FFmpeg processing failed for {input_file}")
+        return None
 
-def process_segment(args):
-    segment_file, request_id = args
-    output_dir = "processed_segments"
-    os.makedirs(output_dir, exist_ok=True)
-    output_segment = os.path.join(output_dir, f"processed_{request_id}_{os.path.basename(segment_file)}")
-    command = f'ffmpeg -i "{segment_file}" -c:v libx265 -preset ultrafast -crf 18 -vf "format=yuv420p" -profile:v main -level 5.1 -tag:v hvc1 -c:a aac -b:a 320k -movflags +faststart "{output_segment}"'
+    s3_key = output_file
 
     try:
-        result = subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
-        logger.info(f"Segment processed successfully: {output_segment}")
-        return output_segment
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Error processing segment {segment_file}: {e.stderr}")
-        logger.error(f"FFmpeg command: {command}")
-        logger.error(f"FFmpeg output: {e.output}")
-        raise
+        logger.info(f"Uploading processed file to S3: {output_file}")
+        storage.upload_file(output_file, bucket_name, s3_key)
+
+        url = storage.presign(bucket_name, s3_key, 3600)
+        logger.info(f"gen presigned url done {suffix}")
+    finally:
+        os.remove(output_file)
+    return url
 
 
 def split_video(inp):
@@ -108,11 +114,15 @@ def split_video(inp):
     command = f'./spatialmkt --input-file {inp}.MOV'
     
     logger.info(f"Executing command: {command}")
-    process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, 
+    with metrics.stage('spatial_export') as stage:
+        process = metrics.Popen(command, shell=True, stdin=subprocess.PIPE, 
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
                                 universal_newlines=True)
     
-    stdout, sterr = process.communicate(input='\n')
+        stdout, sterr = process.communicate(input='\n')
+        stage.add_child(process)
+        stage.failed = process.returncode != 0
+        stage.bytes = os.path.getsize(f'{inp}.MOV')
     
     if process.returncode != 0:
         logger.error(f"failed with code: {process.returncode}")
@@ -120,66 +130,142 @@ def split_video(inp):
     
     logger.info("split done")
     
-    s3_client = boto3.client('s3')
     bucket_name = 'spcut-split'
     result = {}
 
-    logger.info("uploading to s3")
-    for suffix in ['LEFT', 'RIGHT']:
-        input_file = f'{inp}_{suffix}.mov'
-        output_file = f'{inp}_{suffix}_processed.mov'
-        
-        if not os.path.exists(input_file):
-            logger.error(f"not found: {input_file}")
-            return False, {}
-        
-        if not process_video_ffmpeg(input_file, output_file):
-            logger.error(f"FFmpeg processing failed for {input_file}")
+    # both eyes share one transcoder owner, so their segments fill the CPU budget together and the
+    # first eye to finish uploads while the other is still encoding
+    logger.info("encoding and uploading both eyes")
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = {suffix: pool.submit(jobs.bind(process_and_upload_eye), inp, suffix, bucket_name) for suffix in ['LEFT', 'RIGHT']}
+
+    for suffix, future in futures.items():
+        url = future.result()
+        if url is None:
             return False, {}
-        
-        s3_key = output_file
-        
-        logger.info(f"Uploading processed file to S3: {output_file}")
-        s3_client.upload_file(output_file, bucket_name, s3_key)
-        
-        url = s3_client.generate_presigned_url('get_object',
-                                                Params={'Bucket': bucket_name,
-                                                        'Key': s3_key},
-                                                ExpiresIn=3600)
         result[suffix.lower()] = url
-        logger.info(f"gen presigned url done {suffix}")
-
-        os.remove(output_file)
 
     logger.info("all good")
     return True, result
 
-def merge_videos(left_file, right_file, output_file):
-    logger.info(f"merging: {left_file} and {right_file}")
+STACK_FILTER = '[0:v]scale=1920:1080[top]; [1:v]scale=1920:1080[bottom]; [top][bottom]vstack=inputs=2'
+SPATIAL_OU_ARGS = ['-f', 'ou', '--cdist', '19.24', '--hfov', '63.4', '--hadjust', '0.02', '--primary', 'right', '--projection', 'rect']
 
-    command = f'ffmpeg -i {left_file} -i {right_file} -filter_complex "[0:v]scale=1920:1080[top]; [1:v]scale=1920:1080[bottom]; [top][bottom]vstack=inputs=2" -c:v libx264 -pix_fmt yuv420p -s 1920x2160 {output_file}'
-    logger.info(f"executing command: {command}")
 
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-    stdout, stderr = process.communicate()
+def unblock_fifo(path):
+    # a reader stuck in open() on a FIFO whose writer died gets EOF once a writer opens and closes it
+    try:
+        os.close(os.open(path, os.O_WRONLY | os.O_NONBLOCK))
+    except OSError:
+        pass
 
-    if process.returncode != 0:
-        logger.error(f"merge failed: {process.returncode}")
-        logger.error(f"err: {stderr}")
-        return False, stderr
 
-    logger.info("merge done")
+def read_log(path):
+    with open(path, errors='replace') as f:
+        return f.read()[-4000:]
 
-    # Call process_video instead of uploading to S3
-    success, url = process_video(output_file, output_file)
-    if not success:
-        logger.error(f"Failed to process merged video: {output_file}")
-        return False, ""
 
-    # Clean up the merged file
-    cleanup_merged(output_file)
+def merge_videos(left_file, right_file, output_file):
+    # vstack -> ./spatial make -> S3. Stages are joined by FIFOs and the output is streamed to S3
+    # where the tools can handle a non-seekable stream, otherwise through scratch files
+    logger.info(f"merging: {left_file} and {right_file}")
+
+    started = time.time()
+    workdir = tempfile.mkdtemp(prefix='merge_', dir='.')
+    monitor = workspace.DiskMonitor(workdir)
+    s3_key = 'output_' + output_file
+    stacked = os.path.join(workdir, 'stacked.mp4')
+    merged = os.path.join(workdir, s3_key)
+    log_file = os.path.join(workdir, 'merge.log')
+    processes = []
+    with metrics.stage('merge_pipeline') as stage:
+        stage.bytes = os.path.getsize(left_file) + os.path.getsize(right_file)
+        # failures return rather than raise, so the stage counts as failed until the URL is out
+        stage.failed = True
+        try:
+            if config.SPATIAL_PIPE_INPUT:
+                os.mkfifo(stacked)
+            if config.SPATIAL_PIPE_OUTPUT:
+                os.mkfifo(merged)
+
+            with open(log_file, 'w') as log:
+                stack_command = ['ffmpeg', '-y', '-i', left_file, '-i', right_file, '-filter_complex', STACK_FILTER,
+                                 '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-s', '1920x2160',
+                                 '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4', stacked]
+                logger.info(f"executing command: {stack_command}")
+                stack = metrics.Popen(stack_command, stdin=subprocess.DEVNULL, stdout=log, stderr=log)
+                processes.append(stack)
+                if not config.SPATIAL_PIPE_INPUT and stack.wait() != 0:
+                    logger.error(f"merge failed: {stack.returncode}")
+                    return False, read_log(log_file)
+
+                spatial_command = ['./spatial', 'make', '-i', stacked, '-o', merged, *SPATIAL_OU_ARGS]
+                logger.info(f"executing command: {spatial_command}")
+                spatial = metrics.Popen(spatial_command, stdin=subprocess.PIPE, stdout=log, stderr=log,
+                                        universal_newlines=True)
+                processes.append(spatial)
+                try:
+                    spatial.stdin.write('y\n')
+                    spatial.stdin.close()
+                except BrokenPipeError:
+                    pass  # exited already; its return code is checked below
+                if config.SPATIAL_PIPE_INPUT:
+                    # either end of the stacked FIFO blocks in open() or write() once the other one has
+                    # died, so a failure on one side kills the other
+                    def stop_spatial():
+                        if stack.wait() != 0 and spatial.poll() is None:
+                            spatial.kill()
+                    threading.Thread(target=stop_spatial, name='merge-watch', daemon=True).start()
+
+                if config.SPATIAL_PIPE_OUTPUT:
+                    with ThreadPoolExecutor(max_workers=1) as pool:
+                        def stream_output():
+                            with open(merged, 'rb') as stream:
+                                return storage.upload_stream(stream, "spcut-output", s3_key, lambda: spatial.wait() == 0)
+                        upload = pool.submit(jobs.bind(stream_output))
+                        spatial.wait()
+                        unblock_fifo(merged)
+                        try:
+                            upload.result()
+                        except Exception as e:
+                            logger.error(f"Error streaming file to S3: {e}")
+                            return False, ""
+                else:
+                    spatial.wait()
+                if config.SPATIAL_PIPE_INPUT and spatial.returncode != 0 and stack.poll() is None:
+                    stack.kill()
+
+                if stack.wait() != 0 or spatial.returncode != 0:
+                    logger.error(f"merge failed: ffmpeg {stack.returncode}, spatial {spatial.returncode}")
+                    return False, read_log(log_file)
+
+            logger.info("merge done")
+            if not config.SPATIAL_PIPE_OUTPUT:
+                try:
+                    storage.upload_file(merged, "spcut-output", s3_key)
+                except Exception as e:
+                    logger.error(f"Error uploading file to S3: {e}")
+                    return False, ""
+
+            url = storage.presign("spcut-output", s3_key, 3600*24)
+            stage.failed = False
+            return True, url
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                stage.add_child(process)
+            peak = monitor.stop()
+            shutil.rmtree(workdir, ignore_errors=True)
+            elapsed = time.time() - started
+            streamed = [name for name, on in [('stack->spatial', config.SPATIAL_PIPE_INPUT),
+                                              ('spatial->s3', config.SPATIAL_PIPE_OUTPUT)] if on]
+            logger.info(f"merge pipeline: {elapsed:.1f}s end to end, peak scratch disk {peak / config.MB:.1f} MB, "
+                        f"streamed: {', '.join(streamed) or 'none'}")
+            jobs.record('merge_pipeline_seconds', elapsed)
+            jobs.record('merge_peak_disk_bytes', peak)
 
-    return True, url
 
 def cleanup(inp):
     logger.info(f"cleaning: {inp}")
@@ -193,22 +279,15 @@ def cleanup(inp):
     else:
         logger.warning(f"delete: not found: {input_file}")
 
+    # only this job's eyes; a glob here would delete files of concurrent jobs
     for suffix in ['LEFT', 'RIGHT']:
-        pattern = f"*{suffix}.mov"
-        matching_files = glob.glob(pattern)
-        
-        if not matching_files:
-            logger.warning(f"no files found with: {pattern}")
-        
-        for file in matching_files:
-            if os.path.exists(file):
-                try:
-                    os.remove(file)
-                    logger.info(f"deleted: {file}")
-                except Exception as e:
-                    logger.error(f"Failed to delete file {file}: {str(e)}")
-            else:
-                logger.warning(f"File not found: {file}")
+        file = f"{inp}_{suffix}.mov"
+        if os.path.exists(file):
+            try:
+                os.remove(file)
+                logger.info(f"deleted: {file}")
+            except Exception as e:
+                logger.error(f"Failed to delete file {file}: {str(e)}")
 
     logger.info("cleanup done")
     
@@ -262,7 +341,7 @@ def splitVideo():
         success, response = split_video(video_name)
         if not success:
             return jsonify({'error': 'Failed to split video'}), 500
-        cleanup(video_name + '.MOV')
+        cleanup(video_name)
         return jsonify(response), 200
     else:
         return jsonify({'error': 'Failed to download video'}), 500
@@ -301,6 +380,10 @@ def mergeVideos():
     else:
         return jsonify({'error': 'Failed to download one or both videos'}), 500
 
+@app.route('/metrics', methods=['GET'])
+def prometheusMetrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['GET'])
 def test():
     return jsonify({'message': 'Hello World!'})
@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_batches = {}
+_lock = threading.Lock()
+
+
+class Batch:
+    # a group of merge jobs sharing one workspace; each distinct source URL is downloaded once and
+    # deleted when the last item using it is done
+    def __init__(self, ws, items, download):
+        self.id = uuid.uuid4().hex
+        self.ws = ws
+        self.items = items
+        self.download = download
+        self.jobs = []
+        self.created = time.time()
+        self.finished = None
+        self.done_count = 0
+        self.cond = threading.Condition()
+        self.files = {}
+        self.users = {}
+        for item in items:
+            for url in (item['left_url'], item['right_url']):
+                self.users[url] = self.users.get(url, 0) + 1
+
+    def fetch(self, url):
+        # first caller downloads, everyone else waits for it; returns None if the download failed
+        with self.cond:
+            entry = self.files.get(url)
+            owner = entry is None
+            if owner:
+                name = os.path.basename(url.split('?')[0]) or 'input'
+                entry = self.files[url] = {'path': self.ws.path(f'src{len(self.files)}_{name}'),
+                                           'ready': threading.Event(), 'ok': False}
+        if owner:
+            try:
+                entry['ok'] = self.download(url, entry['path'])
+            finally:
+                entry['ready'].set()
+        else:
+            entry['ready'].wait()
+        return entry['path'] if entry['ok'] else None
+
+    def release(self, url):
+        with self.cond:
+            self.users[url] -= 1
+            entry = self.files.get(url) if self.users[url] == 0 else None
+        if entry is not None and os.path.exists(entry['path']):
+            os.remove(entry['path'])
+
+    def item_finished(self, job):
+        with self.cond:
+            self.done_count += 1
+            last = self.done_count == len(self.items)
+            if last:
+                self.finished = time.time()
+            self.cond.notify_all()
+        if last:
+            self.ws.close()
+            logger.info(f"batch {self.id} finished: {len(self.items)} items in {self.finished - self.created:.1f}s")
+
+    def wait(self, sent, timeout):
+        # block until more than `sent` items are finished or the timeout passes
+        with self.cond:
+            self.cond.wait_for(lambda: self.done_count > sent, timeout)
+
+    def item_dict(self, index):
+        item, job = self.items[index], self.jobs[index]
+        return {
+            'index': index,
+            'uid': item['uid'],
+            'job_id': job.id,
+            'status': job.status,
+            'stage': job.stage,
+            'result': job.result,
+            'error': job.error,
+        }
+
+    def touch(self):
+        for job in self.jobs:
+            job.touch()
+
+    def cancel(self, reason):
+        return sum(1 for job in self.jobs if job.cancel(reason))
+
+    def finished_items(self):
+        return [i for i, job in enumerate(self.jobs) if job.finished]
+
+    def to_dict(self):
+        items = [self.item_dict(i) for i in range(len(self.jobs))]
+        counts = {}
+        for item in items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        if self.finished is None:
+            status = 'running'
+        else:
+            # a cancelled item (by the client, a timeout or abandonment) produced nothing, like a failed one
+            lost = counts.get('failed', 0) + counts.get('cancelled', 0)
+            status = 'done' if lost == 0 else 'failed' if 'done' not in counts else 'partial'
+        return {
+            'id': self.id,
+            'status': status,
+            'created': self.created,
+            'finished': self.finished,
+            'counts': counts,
+            'downloads': len(self.users),
+            'items': items,
+        }
+
+
+def register(batch):
+    with _lock:
+        cutoff = time.time() - config.JOB_RESULT_TTL
+        for batch_id in [b.id for b in _batches.values() if b.finished and b.finished < cutoff]:
+            del _batches[batch_id]
+        _batches[batch.id] = batch
+
+
+def get(batch_id):
+    with _lock:
+        return _batches.get(batch_id)
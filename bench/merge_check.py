@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# Correctness check for the chunked merge: merges one pair of eyes with a single ./spatial make and
+# with app.merge_chunked, and compares the two outputs' frame counts and durations. Run it from a
+# directory holding ./spatial (the real tool, or bench/stand_in.py for timing only):
+#
+#   python bench/merge_check.py left.mov right.mov --chunk-seconds 10
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the chunked merge with a single-pass merge.')
+    parser.add_argument('left')
+    parser.add_argument('right')
+    parser.add_argument('--chunk-seconds', type=int, default=10)
+    parser.add_argument('--bitrate', default='20M')
+    parser.add_argument('--quality', default='0.5')
+    parser.add_argument('--keep', action='store_true', help='keep both outputs')
+    args = parser.parse_args()
+
+    os.environ['SPCUT_MERGE_CHUNK_SECONDS'] = str(args.chunk_seconds)
+    import app
+    import transcoder
+
+    workdir = tempfile.mkdtemp(prefix='merge_check_', dir='.')
+    single, chunked = os.path.join(workdir, 'single.mov'), os.path.join(workdir, 'chunked.mov')
+    try:
+        started = time.time()
+        command = (f'./spatial make -i {args.right} -i {args.left} {app.MERGE_ARGS} --bitrate {args.bitrate} '
+                   f'--quality {args.quality} -o {single}')
+        process = app.runner.run(command, shell=True)
+        if process.returncode != 0:
+            sys.exit(f'merge_check: single pass failed: {process.output}')
+        single_seconds = time.time() - started
+
+        started = time.time()
+        if not app.merge_chunked(args.left, args.right, chunked, args.bitrate, args.quality):
+            sys.exit('merge_check: chunked merge did not produce an output, see the log above')
+        chunked_seconds = time.time() - started
+
+        report = {
+            'single': dict(transcoder.stream_stats(single), seconds=round(single_seconds, 3)),
+            'chunked': dict(transcoder.stream_stats(chunked), seconds=round(chunked_seconds, 3)),
+        }
+        report['match'] = transcoder.same_timeline(report['single'], report['chunked'])
+        print(json.dumps(report, indent=2))
+        if not report['match']:
+            sys.exit(1)
+    finally:
+        if args.keep:
+            print(f'merge_check: outputs kept in {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# End-to-end benchmark for app.py that runs entirely on one Linux box: the spatial tools are replaced
+# by bench/stand_in.py, inputs come from a local HTTP origin that synthesizes .MOV files, and uploads
+# go to a local S3 (moto, or any endpoint given with --s3-endpoint). Each endpoint is driven in turn at
+# the given concurrency; the report is JSON so two runs can be diffed with --compare.
+#
+#   python bench/run.py --requests 20 --concurrency 4 --size-mb 256 --output before.json
+#   python bench/run.py --requests 20 --concurrency 4 --size-mb 256 --compare before.json
+#   python bench/run.py --server gunicorn --compare dev.json    # startup and per-request overhead too
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import requests
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKETS = ['spcut-output', 'spcut-split']
+MB = 1024 * 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    # serves /<name>.MOV as `size` bytes of content derived from the name, with Range and a strong ETag
+    daemon_threads = True
+
+    def __init__(self, port, size):
+        super().__init__(('127.0.0.1', port), OriginHandler)
+        self.size = size
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    def block(self, path):
+        with self.lock:
+            if path not in self.blocks:
+                self.blocks[path] = random.Random(path).randbytes(MB)
+            return self.blocks[path]
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body):
+        size = self.server.size
+        start, end = 0, size - 1
+        status = 200
+        header = self.headers.get('Range', '')
+        if header.startswith('bytes='):
+            first, _, last = header[len('bytes='):].partition('-')
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'video/quicktime')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{zlib.crc32(self.path.encode()):08x}-{size}"')
+        self.send_header('Content-Length', str(end - start + 1))
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if not body:
+            return
+
+        block = self.server.block(self.path)
+        offset = start
+        try:
+            while offset <= end:
+                i = offset % MB
+                chunk = block[i:min(MB, i + end - offset + 1)]
+                self.wfile.write(chunk)
+                offset += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def tree_rss(root_pid):
+    # resident memory of a process and all its descendants, from /proc
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{entry}/statm') as f:
+                rss[int(entry)] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        total += rss.get(pid, 0)
+        pending.extend(children.get(pid, []))
+    return total
+
+
+def dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Sampler:
+    def __init__(self, pid, paths, interval=0.2):
+        self.pid = pid
+        self.paths = paths
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, tree_rss(self.pid))
+            self.peak_disk = max(self.peak_disk, sum(dir_size(path) for path in self.paths))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak_rss, self.peak_disk
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def request_body(endpoint, origin, n, args):
+    if args.reuse_inputs:
+        n = 0
+    if endpoint == 'merge':
+        return {'uid': f'bench{n}', 'left_url': f'{origin}/left_{n}.MOV', 'right_url': f'{origin}/right_{n}.MOV',
+                'bitrate': '100M', 'quality': 0.5}
+    return {'url': f'{origin}/{endpoint}_{n}.MOV'}
+
+
+def run_one(base, endpoint, body, timeout):
+    started = time.time()
+    while True:
+        response = requests.post(f'{base}/{endpoint}', json=body, timeout=60)
+        if response.status_code in (429, 507):
+            # the service's Retry-After is sized for real clients; the bench just keeps the pressure on
+            time.sleep(0.5)
+            continue
+        if response.status_code != 202:
+            return {'ok': False, 'seconds': time.time() - started, 'error': f'HTTP {response.status_code}'}
+        break
+
+    status_url = base + response.json()['status_url']
+    while time.time() - started < timeout:
+        job = requests.get(status_url, timeout=60).json()
+        if job['status'] in ('done', 'failed', 'cancelled'):
+            return {'ok': job['status'] == 'done', 'seconds': time.time() - started, 'error': job['error'],
+                    'cache': job['metrics'].get('cache'), 'result': job['result']}
+        time.sleep(0.1)
+    return {'ok': False, 'seconds': time.time() - started, 'error': 'timed out'}
+
+
+def run_roundtrip(base, origin, n, args):
+    # /split, then /merge of the two eyes it returned: the merge inputs come from our own bucket
+    started = time.time()
+    split = run_one(base, 'split', request_body('split', origin, n, args), args.timeout)
+    if not split['ok']:
+        return split
+    body = {'uid': f'roundtrip{n}', 'left_url': split['result']['left'], 'right_url': split['result']['right'],
+            'bitrate': '100M', 'quality': 0.5}
+    merge = run_one(base, 'merge', body, args.timeout)
+    merge['seconds'] = time.time() - started
+    return merge
+
+
+def run_endpoint(base, endpoint, origin, app_pid, scratch, args):
+    sampler = Sampler(app_pid, scratch)
+    started = time.time()
+    if endpoint == 'roundtrip':
+        call = lambda n: run_roundtrip(base, origin, n, args)
+    else:
+        call = lambda n: run_one(base, endpoint, request_body(endpoint, origin, n, args), args.timeout)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    wall = time.time() - started
+    peak_rss, peak_disk = sampler.stop()
+
+    latencies = [r['seconds'] for r in results if r['ok']]
+    ok = len(latencies)
+    inputs = 2 if endpoint == 'merge' else 1
+    errors = sorted({str(r['error']) for r in results if not r['ok']})
+    return {
+        'requests': len(results),
+        'ok': ok,
+        'failed': len(results) - ok,
+        'cache_hits': sum(1 for r in results if r.get('cache') == 'hit'),
+        'wall_seconds': round(wall, 3),
+        'jobs_per_sec': round(ok / wall, 4),
+        'input_mb_per_sec': round(ok * inputs * args.size_mb / wall, 2),
+        'latency_p50': round(percentile(latencies, 50), 3) if latencies else None,
+        'latency_p95': round(percentile(latencies, 95), 3) if latencies else None,
+        'latency_p99': round(percentile(latencies, 99), 3) if latencies else None,
+        'latency_max': round(max(latencies), 3) if latencies else None,
+        'peak_rss_mb': round(peak_rss / MB, 1),
+        'peak_disk_mb': round(peak_disk / MB, 1),
+        'errors': errors[:5],
+    }
+
+
+def start_s3(args, env):
+    if args.s3_endpoint:
+        return args.s3_endpoint, None
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit('bench: no --s3-endpoint given and moto is not installed (pip install "moto[server]")')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        env.setdefault(name, 'bench')
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    return f'http://127.0.0.1:{port}', server
+
+
+def install_stand_ins(run_dir):
+    for name in ('spatial', 'spatialmkt'):
+        path = os.path.join(run_dir, name)
+        shutil.copy(os.path.join(REPO, 'bench', 'stand_in.py'), path)
+        os.chmod(path, 0o755)
+
+
+def wait_ready(base, process, timeout=30):
+    # seconds from now until /readyz answers 200
+    started = time.time()
+    while time.time() < started + timeout:
+        if process.poll() is not None:
+            sys.exit(f'bench: app exited with {process.returncode}')
+        try:
+            if requests.get(base + '/readyz', timeout=1).status_code == 200:
+                return time.time() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.02)
+    sys.exit('bench: app did not come up')
+
+
+def request_overhead(base, count=200):
+    # per-request latency of the server itself: liveness and a status lookup, one keep-alive connection
+    session = requests.Session()
+    result = {}
+    for name, path in (('healthz', '/healthz'), ('status', '/jobs/0')):
+        latencies = []
+        for _ in range(count):
+            started = time.time()
+            session.get(base + path, timeout=10)
+            latencies.append((time.time() - started) * 1000)
+        result[f'{name}_p50_ms'] = round(percentile(latencies, 50), 2)
+        result[f'{name}_p99_ms'] = round(percentile(latencies, 99), 2)
+    return result
+
+
+def start_app(args, run_dir, env, port, log):
+    if args.server == 'gunicorn':
+        env = dict(env, SPCUT_SERVER_BIND=f'127.0.0.1:{port}')
+        command = [sys.executable, os.path.join(REPO, 'server.py')]
+    else:
+        command = [sys.executable, '-c',
+                   f'import app; app.warm(); app.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    return subprocess.Popen(command, cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO, capture_output=True,
+                              universal_newlines=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(base, current):
+    lines = []
+    before, after = base.get('server') or {}, current.get('server') or {}
+    if before and after:
+        lines.append(f"server ({before.get('kind')} -> {after.get('kind')}):")
+        for key in ('startup_seconds', 'healthz_p50_ms', 'healthz_p99_ms', 'status_p50_ms', 'status_p99_ms'):
+            old, new = before.get(key), after.get(key)
+            if old is None or new is None:
+                continue
+            change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+            lines.append(f'  {key:16} {old:>10} -> {new:>10}  {change}')
+    for endpoint, stats in current['endpoints'].items():
+        before = base.get('endpoints', {}).get(endpoint)
+        if not before:
+            continue
+        lines.append(f'{endpoint}:')
+        for key in ('jobs_per_sec', 'latency_p50', 'latency_p95', 'latency_p99', 'peak_rss_mb', 'peak_disk_mb'):
+            old, new = before.get(key), stats.get(key)
+            if old is None or new is None:
+                continue
+            change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+            lines.append(f'  {key:14} {old:>10} -> {new:>10}  {change}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /process, /split and /merge end to end.')
+    parser.add_argument('--endpoints', default='process,split,merge',
+                        help='comma separated; "roundtrip" runs /split then /merge on its outputs')
+    parser.add_argument('--requests', type=int, default=8, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--size-mb', type=int, default=64, help='size of each synthetic input')
+    parser.add_argument('--cpu-per-gb', type=float, default=20, help='stand-in CPU seconds per GB of input')
+    parser.add_argument('--output-ratio', type=float, default=1.0, help='stand-in output bytes per input byte')
+    parser.add_argument('--reuse-inputs', action='store_true', help='send the same inputs every time (cache hits)')
+    parser.add_argument('--s3-endpoint', help='use this S3 endpoint instead of starting moto')
+    parser.add_argument('--timeout', type=float, default=600, help='per-job timeout in seconds')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='JSON report from an earlier run to compare against')
+    parser.add_argument('--keep', action='store_true', help='keep the run directory')
+    parser.add_argument('--server', choices=('dev', 'gunicorn'), default='dev',
+                        help='Flask dev server, or server.py (needs gunicorn)')
+    args = parser.parse_args()
+
+    run_dir = tempfile.mkdtemp(prefix='spcut-bench-')
+    tmpfs_dir = f'/dev/shm/spcut-bench-{os.getpid()}' if os.path.isdir('/dev/shm') else ''
+    install_stand_ins(run_dir)
+
+    env = dict(os.environ)
+    s3_endpoint, s3_server = start_s3(args, env)
+    env.update({
+        'SPCUT_S3_ENDPOINT_URL': s3_endpoint,
+        'SPCUT_TMPFS_DIR': tmpfs_dir,
+        'SPCUT_BENCH_CPU_PER_GB': str(args.cpu_per_gb),
+        'SPCUT_BENCH_OUTPUT_RATIO': str(args.output_ratio),
+        'PYTHONPATH': REPO,
+    })
+    s3 = boto3.client('s3', endpoint_url=s3_endpoint, region_name=env.get('AWS_DEFAULT_REGION', 'us-east-1'),
+                      aws_access_key_id=env.get('AWS_ACCESS_KEY_ID'),
+                      aws_secret_access_key=env.get('AWS_SECRET_ACCESS_KEY'))
+    for bucket in BUCKETS:
+        try:
+            s3.create_bucket(Bucket=bucket)
+        except s3.exceptions.BucketAlreadyOwnedByYou:
+            pass
+
+    origin = Origin(free_port(), args.size_mb * MB)
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+    origin_url = f'http://127.0.0.1:{origin.server_address[1]}'
+
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    log = open(os.path.join(run_dir, 'app.log'), 'w')
+    app = start_app(args, run_dir, env, port, log)
+    report = {
+        'commit': git_commit(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {key: getattr(args, key) for key in ('requests', 'concurrency', 'size_mb', 'cpu_per_gb',
+                                                        'output_ratio', 'reuse_inputs')},
+        'cpus': os.cpu_count(),
+        'endpoints': {},
+    }
+    try:
+        report['server'] = {'kind': args.server, 'startup_seconds': round(wait_ready(base, app), 3)}
+        report['server'].update(request_overhead(base))
+        print(json.dumps(report['server']), file=sys.stderr)
+        scratch = [os.path.join(run_dir, 'workspaces')] + ([tmpfs_dir] if tmpfs_dir else [])
+        for endpoint in args.endpoints.split(','):
+            print(f'bench: {endpoint} x{args.requests} at concurrency {args.concurrency}', file=sys.stderr)
+            report['endpoints'][endpoint] = run_endpoint(base, endpoint, origin_url, app.pid, scratch, args)
+            print(json.dumps(report['endpoints'][endpoint]), file=sys.stderr)
+    finally:
+        app.terminate()
+        try:
+            app.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            app.kill()
+        log.close()
+        origin.shutdown()
+        if s3_server is not None:
+            s3_server.stop()
+        if tmpfs_dir:
+            shutil.rmtree(tmpfs_dir, ignore_errors=True)
+        if args.keep:
+            print(f'bench: run directory kept at {run_dir}', file=sys.stderr)
+        else:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# Stand-in for the macOS-only ./spatial and ./spatialmkt binaries, so the service can be benchmarked on
+# Linux. It reads every input, burns CPU in proportion to the input size and writes outputs of a
+# proportional size. Cost is set through the environment:
+#   SPCUT_BENCH_CPU_PER_GB    CPU seconds per GB of input (default 20)
+#   SPCUT_BENCH_OUTPUT_RATIO  output bytes per input byte, per output file (default 1.0)
+import hashlib
+import os
+import sys
+import time
+
+CHUNK = 1024 * 1024
+GB = 1024 * CHUNK
+
+
+def parse(args):
+    inputs, outputs = [], []
+    for i, arg in enumerate(args):
+        if arg in ('-i', '--input-file') and i + 1 < len(args):
+            inputs.append(args[i + 1])
+        elif arg == '-o' and i + 1 < len(args):
+            outputs.append(args[i + 1])
+    return inputs, outputs
+
+
+def burn(seconds):
+    deadline = time.process_time() + seconds
+    digest = hashlib.sha256()
+    while time.process_time() < deadline:
+        digest.update(b'x' * 4096)
+
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if name == 'spatial' and args and args[0] in ('make', 'export'):
+        command, args = args[0], args[1:]
+    elif name == 'spatialmkt':
+        command = 'export'
+    else:
+        print(f'usage: {name} make|export -i input -o output', file=sys.stderr)
+        return 2
+
+    inputs, outputs = parse(args)
+    if not inputs:
+        print(f'{name}: no input', file=sys.stderr)
+        return 2
+    if not outputs:
+        # spatialmkt names its outputs after the input
+        base = os.path.splitext(inputs[0])[0]
+        outputs = [f'{base}_LEFT.mov', f'{base}_RIGHT.mov'] if command == 'export' else [f'{base}_out.mov']
+
+    size = 0
+    for path in inputs:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK), b''):
+                size += len(chunk)
+
+    cpu_per_gb = float(os.environ.get('SPCUT_BENCH_CPU_PER_GB', 20))
+    steps = 20
+    for step in range(steps):
+        burn(cpu_per_gb * size / GB / steps)
+        print(f'{100.0 * (step + 1) / steps:5.1f}%', flush=True)
+
+    ratio = float(os.environ.get('SPCUT_BENCH_OUTPUT_RATIO', 1.0))
+    block = os.urandom(CHUNK)
+    for path in outputs:
+        remaining = int(size * ratio)
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                f.write(block[:min(CHUNK, remaining)])
+                remaining -= CHUNK
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import os
+
+
+def _int(name, default):
+    return int(os.environ.get(name, default))
+
+
+MB = 1024 * 1024
+
+# downloads
+DOWNLOAD_CHUNK_SIZE = _int('SPCUT_DOWNLOAD_CHUNK_SIZE', 1 * MB)
+DOWNLOAD_PART_SIZE = _int('SPCUT_DOWNLOAD_PART_SIZE', 32 * MB)
+DOWNLOAD_PARALLEL_THRESHOLD = _int('SPCUT_DOWNLOAD_PARALLEL_THRESHOLD', 64 * MB)
+DOWNLOAD_CONNECTIONS = _int('SPCUT_DOWNLOAD_CONNECTIONS', 4)
+DOWNLOAD_RETRIES = _int('SPCUT_DOWNLOAD_RETRIES', 3)
+DOWNLOAD_TIMEOUT = _int('SPCUT_DOWNLOAD_TIMEOUT', 30)
+
+# job pool
+JOB_WORKERS = _int('SPCUT_JOB_WORKERS', 0)  # 0 = encode slots + prefetch
+JOB_PREFETCH = _int('SPCUT_JOB_PREFETCH', 2)
+ENCODE_SLOTS = _int('SPCUT_ENCODE_SLOTS', 0)  # 0 = size from cores/memory
+JOB_MEMORY_PER_WORKER = _int('SPCUT_JOB_MEMORY_PER_WORKER', 2 * 1024 * MB)
+JOB_QUEUE_SIZE = _int('SPCUT_JOB_QUEUE_SIZE', 32)
+JOB_RESULT_TTL = _int('SPCUT_JOB_RESULT_TTL', 24 * 3600)
+JOB_EVENT_BUFFER = _int('SPCUT_JOB_EVENT_BUFFER', 64)
+
+# fair-share scheduling: each uid gets a share of the workers in proportion to its class weight.
+# USER_MAX_RUNNING caps one uid's running jobs while another uid's work waits (0 = no cap)
+PRIORITY_WEIGHTS = {
+    'interactive': _int('SPCUT_INTERACTIVE_WEIGHT', 8),
+    'bulk': _int('SPCUT_BULK_WEIGHT', 1),
+}
+USER_MAX_RUNNING = _int('SPCUT_USER_MAX_RUNNING', 0)
+
+# deadlines in seconds, 0 = none. A stage over its limit or a job over JOB_TIMEOUT fails; a job whose
+# status nobody has read for JOB_ABANDON_TIMEOUT is cancelled
+STAGE_TIMEOUTS = {
+    'download': _int('SPCUT_DOWNLOAD_STAGE_TIMEOUT', 3600),
+    'encode': _int('SPCUT_ENCODE_STAGE_TIMEOUT', 4 * 3600),
+    'split': _int('SPCUT_SPLIT_STAGE_TIMEOUT', 4 * 3600),
+    'upload': _int('SPCUT_UPLOAD_STAGE_TIMEOUT', 3600),
+}
+JOB_TIMEOUT = _int('SPCUT_JOB_TIMEOUT', 8 * 3600)
+JOB_ABANDON_TIMEOUT = _int('SPCUT_JOB_ABANDON_TIMEOUT', 600)
+
+# child processes: output kept per process, and how often progress is published
+PROCESS_OUTPUT_LINES = _int('SPCUT_PROCESS_OUTPUT_LINES', 200)
+PROGRESS_INTERVAL = float(os.environ.get('SPCUT_PROGRESS_INTERVAL', 1.0))
+
+# server.py (gunicorn, threaded workers). Jobs live in a worker's memory, so more than one worker
+# needs a balancer that routes a job's requests back to the worker that took it. Every open
+# /jobs/<id>/events or batch results stream holds a thread
+SERVER_BIND = os.environ.get('SPCUT_SERVER_BIND', '0.0.0.0:80')
+SERVER_WORKERS = _int('SPCUT_SERVER_WORKERS', 1)
+SERVER_THREADS = _int('SPCUT_SERVER_THREADS', 32)
+DRAIN_TIMEOUT = _int('SPCUT_DRAIN_TIMEOUT', 3600)  # how long a stopping worker waits for its jobs
+# proxies in front of the server that append to X-Forwarded-For. Requests without a uid are charged
+# to the client address, which behind a proxy is the proxy's unless this is set
+PROXY_HOPS = _int('SPCUT_PROXY_HOPS', 0)
+
+# s3
+S3_ENDPOINT_URL = os.environ.get('SPCUT_S3_ENDPOINT_URL', '')  # e.g. a local moto server
+S3_MAX_POOL_CONNECTIONS = _int('SPCUT_S3_MAX_POOL_CONNECTIONS', 32)
+S3_MULTIPART_THRESHOLD = _int('SPCUT_S3_MULTIPART_THRESHOLD', 16 * MB)
+S3_PART_SIZE = _int('SPCUT_S3_PART_SIZE', 16 * MB)
+S3_UPLOAD_CONCURRENCY = _int('SPCUT_S3_UPLOAD_CONCURRENCY', 8)
+# presigned URLs into these buckets are fetched with the S3 client instead of plain HTTP
+S3_DIRECT_BUCKETS = [b for b in os.environ.get('SPCUT_S3_DIRECT_BUCKETS', 'spcut-split,spcut-output').split(',') if b]
+
+# local state (indexes, manifests)
+STATE_DIR = os.environ.get('SPCUT_STATE_DIR', '.spcut')
+
+# result cache
+RESULT_CACHE_MAX_ENTRIES = _int('SPCUT_RESULT_CACHE_MAX_ENTRIES', 10000)
+RESULT_CACHE_MAX_BYTES = _int('SPCUT_RESULT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * MB)
+RESULT_CACHE_TTL = _int('SPCUT_RESULT_CACHE_TTL', 7 * 24 * 3600)
+
+# segment transcoder (apptest)
+TRANSCODE_CPU_BUDGET = _int('SPCUT_TRANSCODE_CPU_BUDGET', 0)  # 0 = all cores, shared by every request
+TRANSCODE_THREADS = _int('SPCUT_TRANSCODE_THREADS', 2)
+SEGMENT_SECONDS = _int('SPCUT_SEGMENT_SECONDS', 10)
+TRANSCODE_REMUX = _int('SPCUT_TRANSCODE_REMUX', 1)  # stream-copy inputs that are already HEVC Main 4:2:0
+PROBE_CACHE_SIZE = _int('SPCUT_PROBE_CACHE_SIZE', 256)
+# encoded segments are checkpointed per source so a failed or resubmitted transcode only redoes the
+# missing ones; a failed segment is retried SEGMENT_RETRIES times, checkpoints unused for CHECKPOINT_TTL go
+CHECKPOINT_DIR = os.environ.get('SPCUT_CHECKPOINT_DIR', os.path.join(STATE_DIR, 'transcode'))
+SEGMENT_RETRIES = _int('SPCUT_SEGMENT_RETRIES', 2)
+CHECKPOINT_TTL = _int('SPCUT_CHECKPOINT_TTL', 24 * 3600)
+
+# previews: the first PREVIEW_SECONDS, scaled to PREVIEW_HEIGHT lines at a low bitrate, published
+# while the full encode runs
+PREVIEW_SECONDS = _int('SPCUT_PREVIEW_SECONDS', 10)
+PREVIEW_HEIGHT = _int('SPCUT_PREVIEW_HEIGHT', 540)
+PREVIEW_BITRATE = os.environ.get('SPCUT_PREVIEW_BITRATE', '1M')
+
+# chunked merge: cut both eyes at shared keyframes about every MERGE_CHUNK_SECONDS and run ./spatial make
+# on the chunk pairs, then join the outputs. 0 = one ./spatial make over the whole clip. Needs an ffmpeg
+# whose mov muxer keeps the MV-HEVC sample entry; a joined output whose frame count, duration or sample
+# entry boxes don't match falls back to the single pass. MERGE_CHUNK_PARALLEL is how many chunk processes
+# run at once across all jobs (0 = the encode slots). Single-pass merges still take encode slots, so the
+# two add up: size them together against the cores, since ./spatial picks its own thread count
+MERGE_CHUNK_SECONDS = _int('SPCUT_MERGE_CHUNK_SECONDS', 0)
+MERGE_CHUNK_PARALLEL = _int('SPCUT_MERGE_CHUNK_PARALLEL', 0)
+
+# streaming merge pipeline (apptest): set when ./spatial can read/write a non-seekable fragmented MP4
+SPATIAL_PIPE_INPUT = _int('SPCUT_SPATIAL_PIPE_INPUT', 0)
+SPATIAL_PIPE_OUTPUT = _int('SPCUT_SPATIAL_PIPE_OUTPUT', 0)
+
+# per-job workspaces and admission control
+WORKSPACE_DIR = os.environ.get('SPCUT_WORKSPACE_DIR', 'workspaces')
+TMPFS_DIR = os.environ.get('SPCUT_TMPFS_DIR', '/dev/shm/spcut')  # empty disables tmpfs placement
+TMPFS_MAX_JOB_BYTES = _int('SPCUT_TMPFS_MAX_JOB_BYTES', 512 * MB)
+TMPFS_BUDGET = _int('SPCUT_TMPFS_BUDGET', 2 * 1024 * MB)
+WORKSPACE_MIN_FREE = _int('SPCUT_WORKSPACE_MIN_FREE', 1024 * MB)
+WORKSPACE_DEFAULT_INPUT_BYTES = _int('SPCUT_WORKSPACE_DEFAULT_INPUT_BYTES', 2 * 1024 * MB)
+# scratch bytes per input byte: the input plus everything derived from it on local disk
+WORKSPACE_EXPANSION = {'process': 2.5, 'split': 3.0, 'merge': 2.5}
+
+# downloaded sources kept across jobs (0 disables; unused entries are also evicted when a job needs
+# their disk), and the janitors that clear what crashed jobs leave in the cache and the workspaces
+MEDIA_CACHE_DIR = os.environ.get('SPCUT_MEDIA_CACHE_DIR', 'media_cache')
+MEDIA_CACHE_MAX_BYTES = _int('SPCUT_MEDIA_CACHE_MAX_BYTES', 20 * 1024 * MB)
+JANITOR_INTERVAL = _int('SPCUT_JANITOR_INTERVAL', 300)
+ORPHAN_MIN_AGE = _int('SPCUT_ORPHAN_MIN_AGE', 3600)  # a partial download untouched this long is abandoned
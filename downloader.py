@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from botocore.exceptions import BotoCoreError, ClientError
+
+import config
+import jobs
+import metrics
+import storage
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DownloadError(Exception):
+    pass
+
+
+def _session():
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+def probe(url):
+    # a one-byte ranged GET instead of HEAD: presigned S3 URLs are only signed for GET. It is also
+    # what checks the signature, so it comes before anything is read with our own S3 credentials
+    try:
+        response = _session().get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=config.DOWNLOAD_TIMEOUT)
+    except requests.RequestException as e:
+        raise DownloadError(f"probe failed for {url}: {e}") from e
+
+    with response:
+        if response.status_code == 206:
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            size = int(total) if total.isdigit() else None
+            ranges = size is not None
+        elif response.status_code == 200:
+            length = response.headers.get('Content-Length')
+            size = int(length) if length and length.isdigit() else None
+            ranges = False
+        elif response.status_code == 416:
+            size, ranges = 0, False
+        else:
+            raise DownloadError(f"probe failed for {url}: {response.status_code}")
+
+        info = {
+            'size': size,
+            'ranges': ranges,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        }
+    # S3 accepted the URL, so the bulk transfer may go through the pooled client
+    location = storage.parse_url(url)
+    if location is not None and size is not None:
+        info['s3'] = location
+    return info
+
+
+def _load_state(state_path, info):
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('size') != info['size'] or state.get('etag') != info['etag']:
+        return None
+    return state
+
+
+def _save_state(state_path, state, lock):
+    with lock:
+        data = json.dumps(state)
+    with open(state_path, 'w') as f:
+        f.write(data)
+
+
+def _fetch_range(url, tmp_path, part, etag):
+    start, end = part[0], part[1]
+    attempt = 0
+    while start + part[2] <= end:
+        offset = start + part[2]
+        headers = {'Range': f'bytes={offset}-{end}'}
+        if etag:
+            headers['If-Range'] = etag
+        try:
+            with _session().get(url, headers=headers, stream=True, timeout=config.DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 206:
+                    raise DownloadError(f"range {offset}-{end} returned {response.status_code}, source changed?")
+                with open(tmp_path, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in response.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+                        jobs.check_cancelled()
+                        f.write(chunk)
+                        part[2] += len(chunk)
+            if start + part[2] <= end:
+                raise requests.ConnectionError(f"short read on range {offset}-{end}")
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt > config.DOWNLOAD_RETRIES:
+                raise DownloadError(f"range {offset}-{end} failed after {attempt} attempts: {e}") from e
+            logger.warning(f"range {offset}-{end} dropped ({e}), resuming at {start + part[2]}")
+            time.sleep(min(2 ** attempt, 10))
+
+
+def _fetch_parts(url, tmp_path, state_path, state):
+    lock = threading.Lock()
+    pending = [part for part in state['parts'] if part[0] + part[2] <= part[1]]
+
+    def fetch(part):
+        _fetch_range(url, tmp_path, part, state['etag'])
+        _save_state(state_path, state, lock)
+
+    workers = max(1, min(config.DOWNLOAD_CONNECTIONS, len(pending)))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(jobs.bind(fetch), pending))
+    finally:
+        _save_state(state_path, state, lock)
+
+
+def _fetch_stream(url, tmp_path):
+    attempt = 0
+    while True:
+        try:
+            with _session().get(url, stream=True, timeout=config.DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f"download failed for {url}: {response.status_code}")
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(config.DOWNLOAD_CHUNK_SIZE):
+                        jobs.check_cancelled()
+                        f.write(chunk)
+            return
+        except requests.RequestException as e:
+            attempt += 1
+            if attempt > config.DOWNLOAD_RETRIES:
+                raise DownloadError(f"download failed for {url} after {attempt} attempts: {e}") from e
+            logger.warning(f"download dropped ({e}), restarting (no range support)")
+            time.sleep(min(2 ** attempt, 10))
+
+
+def download(url, save_path):
+    with metrics.stage('download') as stage:
+        stats = _download(url, save_path)
+        stage.bytes = stats['fetched']
+    return stats
+
+
+def _download_s3(bucket, key, tmp_path):
+    try:
+        storage.download_file(bucket, key, tmp_path)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"s3 download of s3://{bucket}/{key} failed, falling back to http: {e}")
+        return False
+    return True
+
+
+def _download(url, save_path):
+    info = probe(url)
+    tmp_path = save_path + '.part'
+    state_path = tmp_path + '.json'
+    started = time.time()
+    resumed = 0
+    parts = 1
+
+    if info.get('s3') and _download_s3(*info['s3'], tmp_path):
+        parts = max(1, -(-info['size'] // config.S3_PART_SIZE))
+    elif info['ranges'] and info['size']:
+        size = info['size']
+        state = _load_state(state_path, info) if os.path.exists(tmp_path) else None
+        if state is None:
+            part_size = config.DOWNLOAD_PART_SIZE if size >= config.DOWNLOAD_PARALLEL_THRESHOLD else size
+            state = {
+                'size': size,
+                'etag': info['etag'],
+                'parts': [[start, min(start + part_size, size) - 1, 0] for start in range(0, size, part_size)],
+            }
+            with open(tmp_path, 'wb') as f:
+                f.truncate(size)
+        else:
+            resumed = sum(part[2] for part in state['parts'])
+            logger.info(f"resuming {save_path} from {resumed} bytes")
+        parts = len(state['parts'])
+        _fetch_parts(url, tmp_path, state_path, state)
+    else:
+        _fetch_stream(url, tmp_path)
+
+    os.replace(tmp_path, save_path)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+    elapsed = max(time.time() - started, 1e-6)
+    size = os.path.getsize(save_path)
+    stats = {
+        'bytes': size,
+        'fetched': size - resumed,
+        'seconds': elapsed,
+        'bytes_per_sec': (size - resumed) / elapsed,
+        'parts': parts,
+        'ranges': info['ranges'],
+        's3': bool(info.get('s3')),
+    }
+    logger.info(f"downloaded {save_path}: {size} bytes in {elapsed:.2f}s "
+                f"({stats['bytes_per_sec'] / config.MB:.1f} MB/s, {parts} part(s){' from s3' if stats['s3'] else ''})")
+    return stats
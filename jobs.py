@@ -0,0 +1,556 @@
+import collections
+import logging
+import os
+import signal
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobFailed(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+def default_encode_slots():
+    if config.ENCODE_SLOTS > 0:
+        return config.ENCODE_SLOTS
+    cores = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return cores
+    return max(1, min(cores, memory // config.JOB_MEMORY_PER_WORKER))
+
+
+def default_workers():
+    if config.JOB_WORKERS > 0:
+        return config.JOB_WORKERS
+    # extra workers download/upload for the next jobs while the encode slots are busy
+    return encoder_slots.slots + config.JOB_PREFETCH
+
+
+def current_job():
+    return getattr(_current, 'job', None)
+
+
+def set_stage(name):
+    job = current_job()
+    if job is not None:
+        job.set_stage(name)
+
+
+def progress(data):
+    job = current_job()
+    if job is not None:
+        job.progress = data
+        job.publish('progress', data)
+
+
+def set_preview(url):
+    job = current_job()
+    if job is not None:
+        job.preview = url
+        job.publish('preview', {'url': url})
+
+
+def cancel_check():
+    # a callable that raises Cancelled once the calling thread's job is cancelled; usable from
+    # threads that don't carry the job, like boto3 transfer callbacks
+    job = current_job()
+
+    def check(*_):
+        if job is not None and job.cancelled.is_set():
+            raise Cancelled(job.cancel_reason)
+    return check
+
+
+def check_cancelled():
+    cancel_check()()
+
+
+def kill_group(process):
+    # children are started with start_new_session=True, so their pid is also their process group
+    if process.poll() is None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+@contextmanager
+def track(process):
+    # while inside, cancelling the current job kills process and everything it started
+    job = current_job()
+    if job is None:
+        yield
+        return
+    with job.cond:
+        job.processes.add(process)
+    if job.cancelled.is_set():
+        kill_group(process)
+    try:
+        yield
+    finally:
+        with job.cond:
+            job.processes.discard(process)
+
+
+def defer(func):
+    # runs func when the current job finishes; outside a job there is nothing to wait for
+    job = current_job()
+    if job is None:
+        func()
+        return
+    job.deferred.append(func)
+
+
+def record(name, value):
+    job = current_job()
+    if job is not None:
+        job.metrics[name] = value
+
+
+def record_stage(stage):
+    job = current_job()
+    if job is not None:
+        job.metrics.setdefault('stages', []).append(stage)
+
+
+def bind(func):
+    # run func in another thread on behalf of the calling thread's job
+    job = current_job()
+
+    def run(*args, **kwargs):
+        previous = current_job()
+        _current.job = job
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.job = previous
+    return run
+
+
+class EncoderSlots:
+    def __init__(self, slots):
+        self.slots = slots
+        self.semaphore = threading.BoundedSemaphore(slots)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.busy_total = 0.0
+        self.busy_since = None
+
+    def busy_seconds(self):
+        # wall time during which at least one encode was running
+        with self.lock:
+            if self.active:
+                return self.busy_total + time.time() - self.busy_since
+            return self.busy_total
+
+    @contextmanager
+    def acquire(self, stage):
+        set_stage(f'{stage}_queued')
+        waited = time.time()
+        while not self.semaphore.acquire(timeout=1):
+            check_cancelled()
+        try:
+            record(f'{stage}_wait_seconds', time.time() - waited)
+            set_stage(stage)
+            with self.lock:
+                if not self.active:
+                    self.busy_since = time.time()
+                self.active += 1
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    if not self.active:
+                        self.busy_total += time.time() - self.busy_since
+        finally:
+            self.semaphore.release()
+
+
+encoder_slots = EncoderSlots(default_encode_slots())
+
+
+class Job:
+    def __init__(self, kind, func, args, on_finish=None, owner=None, priority='interactive', cost=1):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.owner = owner
+        self.priority = priority
+        self.cost = cost
+        self.finish_tag = 0.0
+        self.func = func
+        self.args = args
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = []
+        self.metrics = {}
+        self.progress = None
+        self.preview = None
+        self.key = None
+        self.coalesced = 0
+        self.deferred = []
+        self.on_finish = on_finish
+        # recent events for /jobs/<id>/events; a late subscriber still gets the final status
+        self.events = collections.deque(maxlen=config.JOB_EVENT_BUFFER)
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.stage_started = self.created
+        self.last_seen = self.created
+        self.cancelled = threading.Event()
+        self.cancel_reason = None
+        self.cancel_status = 'cancelled'
+        self.processes = set()
+        # the Scheduler holding the job until a worker takes it
+        self.queue = None
+
+    def touch(self):
+        self.last_seen = time.time()
+
+    def cancel(self, reason, status='cancelled'):
+        # stops the job at its next check and kills its child processes now; cleanup (workspace,
+        # multipart uploads) happens as the job unwinds, or right here if no worker has taken it yet
+        with self.cond:
+            if self.finished or self.cancelled.is_set():
+                return False
+            self.cancel_reason = reason
+            self.cancel_status = status
+            self.cancelled.set()
+            processes = list(self.processes)
+        logger.warning(f"cancelling job {self.id} ({self.kind}): {reason}")
+        for process in processes:
+            kill_group(process)
+        self.publish('cancel', {'reason': reason})
+        if self.queue is not None and self.queue.remove(self):
+            self._finish()
+        return True
+
+    def publish(self, event, data):
+        with self.cond:
+            self.seq += 1
+            self.events.append((self.seq, event, data))
+            self.cond.notify_all()
+
+    def events_since(self, seq, timeout):
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq, timeout)
+            return [e for e in self.events if e[0] > seq]
+
+    def _close_stage(self, now):
+        if self.stages and 'seconds' not in self.stages[-1]:
+            self.stages[-1]['seconds'] = now - self.stages[-1]['started']
+
+    def set_stage(self, name):
+        now = time.time()
+        self._close_stage(now)
+        self.stage = name
+        self.stages.append({'name': name, 'started': now})
+        self.stage_started = now
+        self.progress = None
+        self.publish('stage', {'stage': name})
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        self.metrics['queue_wait_seconds'] = round(self.started - self.created, 3)
+        _current.job = self
+        try:
+            check_cancelled()
+            self.result = self.func(*self.args)
+            self.status = 'done'
+        except Cancelled as e:
+            logger.warning(f"job {self.id} ({self.kind}) stopped: {e}")
+            self.error = str(e)
+            self.status = self.cancel_status
+        except JobFailed as e:
+            logger.error(f"job {self.id} ({self.kind}) failed: {e}")
+            self.error = str(e)
+            self.status = 'failed'
+        except Exception as e:
+            logger.exception(f"job {self.id} ({self.kind}) failed")
+            self.error = str(e)
+            self.status = 'failed'
+        finally:
+            _current.job = None
+            self._finish()
+
+    def _finish(self):
+        if self.cancelled.is_set() and self.status != 'done':
+            # the job may have turned the killed child into an ordinary failure
+            self.error = self.cancel_reason
+            self.status = self.cancel_status
+        self.finished = time.time()
+        self._close_stage(self.finished)
+        self.stage = self.status
+        self.publish('status', {'status': self.status, 'result': self.result, 'error': self.error})
+        for func in self.deferred:
+            try:
+                func()
+            except Exception:
+                logger.exception(f"job {self.id} ({self.kind}) deferred cleanup failed")
+        if self.on_finish is not None:
+            try:
+                self.on_finish(self)
+            except Exception:
+                logger.exception(f"job {self.id} ({self.kind}) finish callback failed")
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'owner': self.owner,
+            'priority': self.priority,
+            'coalesced': self.coalesced,
+            'status': self.status,
+            'stage': self.stage,
+            'progress': self.progress,
+            'preview': self.preview,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'stages': [{'name': s['name'], 'seconds': s.get('seconds')} for s in self.stages],
+            'metrics': self.metrics,
+        }
+
+
+class Scheduler:
+    # self-clocked weighted fair queueing over (priority class, owner) flows. A job's finish tag is
+    # where its flow's previous job finished (or the current virtual time) plus cost / class weight,
+    # and the smallest tag among flow heads whose owner is under the running cap goes next; an owner
+    # at its cap still runs when nobody else waits. Each class has its own queue capacity so a bulk
+    # flood can't lock out interactive work
+    def __init__(self, maxsize, weights, user_max_running):
+        self.maxsize = maxsize
+        self.weights = weights
+        self.user_max_running = user_max_running
+        self.flows = {}
+        self.last_finish = {}
+        self.running = {}
+        self.vtime = 0.0
+        self.cond = threading.Condition()
+        self.on_dispatch = None
+
+    def qsize(self, priority=None):
+        with self.cond:
+            return sum(len(q) for (p, _), q in self.flows.items() if priority in (None, p))
+
+    def depths(self):
+        with self.cond:
+            result = {(p,): 0 for p in self.weights}
+            for (p, _), q in self.flows.items():
+                result[(p,)] += len(q)
+            return result
+
+    def put(self, jobs):
+        with self.cond:
+            for priority in {job.priority for job in jobs}:
+                queued = sum(len(q) for (p, _), q in self.flows.items() if p == priority)
+                wanted = sum(1 for job in jobs if job.priority == priority)
+                if queued + wanted > self.maxsize:
+                    raise QueueFull(f"{priority} queue full: {queued} queued, {wanted} more requested")
+            for job in jobs:
+                flow = (job.priority, job.owner)
+                job.finish_tag = max(self.vtime, self.last_finish.get(flow, 0.0)) + job.cost / self.weights[job.priority]
+                self.last_finish[flow] = job.finish_tag
+                self.flows.setdefault(flow, collections.deque()).append(job)
+                job.queue = self
+            self.cond.notify_all()
+
+    def remove(self, job):
+        # takes a job back out of its flow; False if a worker already has it
+        with self.cond:
+            q = self.flows.get((job.priority, job.owner))
+            if q is None or job not in q:
+                return False
+            q.remove(job)
+            return True
+
+    def _pick(self):
+        best = capped = None
+        for (priority, owner), q in self.flows.items():
+            if not q:
+                continue
+            if self.user_max_running and self.running.get(owner, 0) >= self.user_max_running:
+                if capped is None or q[0].finish_tag < capped[0].finish_tag:
+                    capped = q
+            elif best is None or q[0].finish_tag < best[0].finish_tag:
+                best = q
+        return best or capped
+
+    def get(self):
+        with self.cond:
+            while True:
+                q = self._pick()
+                if q is not None:
+                    break
+                self.cond.wait()
+            job = q.popleft()
+            self.vtime = job.finish_tag
+            self.running[job.owner] = self.running.get(job.owner, 0) + 1
+            # idle flows whose tags have been passed carry no credit, drop them
+            for flow in [f for f, fq in self.flows.items() if not fq and self.last_finish.get(f, 0) <= self.vtime]:
+                del self.flows[flow]
+                self.last_finish.pop(flow, None)
+        if self.on_dispatch is not None:
+            self.on_dispatch(job, time.time() - job.created)
+        return job
+
+    def done(self, job):
+        with self.cond:
+            self.running[job.owner] -= 1
+            if not self.running[job.owner]:
+                del self.running[job.owner]
+            self.cond.notify_all()
+
+
+class JobManager:
+    def __init__(self, workers=None, max_queue=None):
+        self.workers = workers or default_workers()
+        self.queue = Scheduler(max_queue or config.JOB_QUEUE_SIZE, config.PRIORITY_WEIGHTS, config.USER_MAX_RUNNING)
+        self.jobs = {}
+        # queued or running jobs by request identity, so a repeat of the same request attaches to them
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.draining = threading.Event()
+        self.threads = [threading.Thread(target=self._worker, name=f'job-worker-{i}', daemon=True)
+                        for i in range(self.workers)]
+        self.threads.append(threading.Thread(target=self._watchdog, name='job-watchdog', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        logger.info(f"job pool started: {self.workers} workers, {encoder_slots.slots} encode slots, "
+                    f"queue size {self.queue.maxsize} per class, running cap per user {self.queue.user_max_running or 'none'}")
+
+    def attach(self, key):
+        # the live job already doing this request, if any
+        with self.lock:
+            job = self.inflight.get(key)
+            if job is None or job.finished or job.cancelled.is_set():
+                return None
+            job.coalesced += 1
+        logger.info(f"request coalesced into job {job.id} ({job.kind}), {job.coalesced} attached")
+        return job
+
+    def detach(self, job):
+        # one of several attached requests gives up; the job keeps running for the others
+        with self.lock:
+            if job.coalesced == 0 or job.finished:
+                return False
+            job.coalesced -= 1
+            return True
+
+    def submit(self, kind, func, *args, on_finish=None, owner=None, priority='interactive', cost=1, key=None):
+        job = Job(kind, func, args, on_finish, owner, priority, cost)
+        with self.lock:
+            self._prune()
+            self.queue.put([job])
+            self.jobs[job.id] = job
+            if key is not None:
+                job.key = key
+                self.inflight[key] = job
+        logger.info(f"queued job {job.id} ({kind}, {priority}, owner {owner})")
+        return job
+
+    def submit_many(self, kind, calls, on_finish=None, priority='bulk', cost=1):
+        # all or nothing: calls is [(func, args, owner), ...]
+        new = [Job(kind, func, args, on_finish, owner, priority, cost) for func, args, owner in calls]
+        with self.lock:
+            self._prune()
+            self.queue.put(new)
+            for job in new:
+                self.jobs[job.id] = job
+        logger.info(f"queued {len(new)} {kind} jobs ({priority})")
+        return new
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id, reason='cancelled by client'):
+        job = self.get(job_id)
+        return job is not None and job.cancel(reason)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(1)
+            now = time.time()
+            with self.lock:
+                active = [job for job in self.jobs.values() if not job.finished]
+            for job in active:
+                limit = config.STAGE_TIMEOUTS.get(job.stage)
+                if config.JOB_ABANDON_TIMEOUT and now - job.last_seen > config.JOB_ABANDON_TIMEOUT:
+                    job.cancel(f'abandoned: status not read for {config.JOB_ABANDON_TIMEOUT}s')
+                elif job.started and limit and now - job.stage_started > limit:
+                    job.cancel(f'stage {job.stage} timed out after {limit}s', 'failed')
+                elif job.started and config.JOB_TIMEOUT and now - job.started > config.JOB_TIMEOUT:
+                    job.cancel(f'timed out after {config.JOB_TIMEOUT}s', 'failed')
+
+    def alive(self):
+        return all(thread.is_alive() for thread in self.threads)
+
+    def active(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def drain(self, timeout):
+        # stop taking jobs and wait for the queued and running ones; True if they all finished
+        self.draining.set()
+        deadline = time.time() + timeout
+        logger.info(f"draining: {self.active()} jobs to finish, waiting up to {timeout}s")
+        while self.active() and time.time() < deadline:
+            time.sleep(1)
+        left = self.active()
+        if left:
+            logger.warning(f"drain timed out with {left} jobs unfinished")
+        else:
+            logger.info("drained")
+        return not left
+
+    def counts(self):
+        with self.lock:
+            result = {}
+            for job in self.jobs.values():
+                result[(job.status,)] = result.get((job.status,), 0) + 1
+            return result
+
+    def _prune(self):
+        # jobs cancelled while queued finish without a worker, so their in-flight entries go here
+        for key in [k for k, job in self.inflight.items() if job.finished]:
+            del self.inflight[key]
+        cutoff = time.time() - config.JOB_RESULT_TTL
+        for job_id in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            del self.jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                self.queue.done(job)
+                with self.lock:
+                    if job.key is not None and self.inflight.get(job.key) is job:
+                        del self.inflight[job.key]
@@ -0,0 +1,266 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+
+import config
+import downloader
+import workspace
+
+logger = logging.getLogger(__name__)
+
+
+# query parameters that only sign or expire a URL, not pick what it points at (S3 SigV4 and V2,
+# CloudFront, GCS)
+SIGNATURE_PARAMS = {'signature', 'expires', 'awsaccesskeyid', 'policy', 'key-pair-id', 'x-amz-security-token'}
+SIGNATURE_PREFIXES = ('x-amz-', 'x-goog-')
+
+
+def source_key(url, info):
+    # same object whatever the signature on the URL: s3 location for our buckets, else the URL with
+    # its signature parameters dropped
+    if info.get('s3'):
+        return 's3://' + '/'.join(info['s3'])
+    parsed = urllib.parse.urlparse(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+             if k.lower() not in SIGNATURE_PARAMS and not k.lower().startswith(SIGNATURE_PREFIXES)]
+    key = f'{parsed.scheme}://{parsed.netloc}{parsed.path}'
+    return key + '?' + urllib.parse.urlencode(sorted(query)) if query else key
+
+
+def validator(info):
+    # what must still match for a cached copy to be used; None if the origin gives nothing to check
+    if not info['etag'] and not info['last_modified']:
+        return None
+    return [info['etag'], info['last_modified'], info['size']]
+
+
+class MediaCache:
+    # downloaded sources kept on local disk across jobs and endpoints, least recently used evicted
+    # first. An entry is revalidated against the origin on every use and is never evicted while a
+    # job holds a reference to it. Each file has a .json sidecar so the cache survives a restart
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.enabled:
+            os.makedirs(root, exist_ok=True)
+            self._load()
+            threading.Thread(target=self._janitor, name='media-janitor', daemon=True).start()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.root, name[:-len('.json')])
+            try:
+                with open(path + '.json') as f:
+                    meta = json.load(f)
+                st = os.stat(path)
+            except (OSError, ValueError):
+                continue
+            if st.st_size != meta['size']:
+                continue
+            entries.append((st.st_atime, meta['key'], self._entry(path, meta['validator'], st.st_size)))
+        for _, key, entry in sorted(entries):
+            self.entries[key] = entry
+        logger.info(f"media cache {self.root}: {len(self.entries)} files, {self.size() / config.MB:.0f} MB")
+
+    def _entry(self, path, validator, size=0, ready=True):
+        entry = {'path': path, 'validator': validator, 'size': size, 'refs': 0, 'ready': threading.Event(), 'ok': True}
+        if ready:
+            entry['ready'].set()
+        return entry
+
+    def size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def fetch(self, url, save_path):
+        # puts the source at save_path and returns a release function; the cached file stays
+        # referenced until it is called
+        if not self.enabled:
+            downloader.download(url, save_path)
+            return lambda: None
+
+        info = downloader.probe(url)
+        check = validator(info)
+        if check is None:
+            downloader.download(url, save_path)
+            return lambda: None
+        key = source_key(url, info)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            stale = entry is not None and entry['ready'].is_set() and (not entry['ok'] or entry['validator'] != check)
+            changing = entry is not None and not entry['ready'].is_set() and entry['validator'] != check
+            if (stale and entry['refs']) or changing:
+                # changed at the origin while a job still uses or fetches the old copy; this one goes uncached
+                self.misses += 1
+                entry = None
+            else:
+                if stale:
+                    self._remove(key)
+                owner = stale or entry is None
+                if owner:
+                    self.misses += 1
+                    path = os.path.join(self.root, hashlib.sha256(key.encode()).hexdigest()[:32])
+                    entry = self.entries[key] = self._entry(path, check, ready=False)
+                else:
+                    self.entries.move_to_end(key)
+                entry['refs'] += 1
+
+        if entry is None:
+            downloader.download(url, save_path)
+            return lambda: None
+        release = self._releaser(key, entry)
+        try:
+            if owner:
+                self._download(url, key, entry)
+            else:
+                entry['ready'].wait()
+                if not entry['ok']:
+                    raise downloader.DownloadError(f"cached download of {key} failed")
+                with self.lock:
+                    self.hits += 1
+                logger.info(f"media cache hit: {key}")
+            self._link(entry['path'], save_path)
+        except BaseException:
+            release()
+            raise
+        return release
+
+    def _download(self, url, key, entry):
+        try:
+            downloader.download(url, entry['path'])
+            entry['size'] = os.path.getsize(entry['path'])
+            with open(entry['path'] + '.json', 'w') as f:
+                json.dump({'key': key, 'validator': entry['validator'], 'size': entry['size']}, f)
+        except BaseException:
+            entry['ok'] = False
+            raise
+        finally:
+            entry['ready'].set()
+        self._evict()
+
+    def _releaser(self, key, entry):
+        released = []
+
+        def release():
+            with self.lock:
+                if released:
+                    return
+                released.append(True)
+                entry['refs'] -= 1
+                failed = not entry['ok'] and not entry['refs']
+                if failed and self.entries.get(key) is entry:
+                    self._remove(key)
+            self._evict()
+        return release
+
+    def _link(self, path, save_path):
+        # a hard link shares the bytes; across filesystems (tmpfs workspaces) it has to be a copy
+        try:
+            os.link(path, save_path)
+        except OSError:
+            shutil.copyfile(path, save_path)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        for path in (entry['path'], entry['path'] + '.json', entry['path'] + '.part', entry['path'] + '.part.json'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _evict(self, free=0):
+        # down to max_bytes, or further by free bytes when admission needs the disk
+        with self.lock:
+            total = self.size()
+            limit = min(self.max_bytes, total - free)
+            for key in list(self.entries):
+                if total <= limit:
+                    break
+                entry = self.entries[key]
+                if entry['refs'] or not entry['ready'].is_set():
+                    continue
+                total -= entry['size']
+                self._remove(key)
+                self.evictions += 1
+                logger.info(f"media cache evicted {key} ({entry['size'] / config.MB:.0f} MB)")
+
+    def reclaim(self, root, need):
+        # workspace admission is need bytes short on root; only helps if the cache shares its disk
+        try:
+            if os.stat(self.root).st_dev != os.stat(root).st_dev:
+                return
+        except OSError:
+            return
+        with self.lock:
+            unused = sum(e['size'] for e in self.entries.values() if not e['refs'] and e['ready'].is_set())
+        # emptying the cache for a job that still won't fit helps nobody
+        if unused >= need:
+            self._evict(need)
+
+    def sweep(self):
+        # what a crash leaves behind: partial downloads nobody is writing, and files or sidecars
+        # missing their other half. Whole entries this process doesn't know are left alone
+        with self.lock:
+            active = {entry['path'] for entry in self.entries.values() if not entry['ready'].is_set()}
+        names = set(os.listdir(self.root))
+        cutoff = time.time() - config.ORPHAN_MIN_AGE
+        removed = 0
+        for name in names:
+            path = os.path.join(self.root, name)
+            if '.part' in name:
+                orphan = path.split('.part')[0] not in active
+            elif name.endswith('.json'):
+                orphan = name[:-len('.json')] not in names
+            else:
+                orphan = name + '.json' not in names and path not in active
+            try:
+                if orphan and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info(f"media cache: removed {removed} orphaned files")
+        return removed
+
+    def _janitor(self):
+        while True:
+            time.sleep(config.JANITOR_INTERVAL)
+            try:
+                self.sweep()
+                self._evict()
+            except Exception:
+                logger.exception("janitor pass failed")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.entries),
+                'bytes': self.size(),
+                'max_bytes': self.max_bytes,
+                'in_use': sum(1 for entry in self.entries.values() if entry['refs']),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+cache = MediaCache(config.MEDIA_CACHE_DIR, config.MEDIA_CACHE_MAX_BYTES)
+if cache.enabled:
+    workspace.reclaimers.append(cache.reclaim)
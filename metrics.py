@@ -0,0 +1,168 @@
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+import jobs
+
+TIME_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 3600)
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+RSS_BUCKETS = tuple(mb * 1024 * 1024 for mb in (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+
+_lock = threading.Lock()
+_registry = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        _registry.append(self)
+
+    def inc(self, value=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with _lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Gauge:
+    # value is read at scrape time; func returns a number or {label values tuple: number}
+    def __init__(self, name, help, func, labelnames=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        value = self.func()
+        values = value if isinstance(value, dict) else {(): value}
+        for key, v in sorted(values.items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {v}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=TIME_BUCKETS, labelnames=('stage',)):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self.series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with _lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        with _lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series['buckets']):
+                    lines.append(f'{self.name}_bucket{_labels(names, key + (bound,))} {count}')
+                lines.append(f'{self.name}_bucket{_labels(names, key + ("+Inf",))} {series["count"]}')
+                lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {series["sum"]}')
+                lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {series["count"]}')
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram('spcut_stage_seconds', 'Wall time per pipeline stage.', labelnames=('stage', 'status'))
+STAGE_BYTES = Counter('spcut_stage_bytes_total', 'Bytes processed per pipeline stage.', ('stage',))
+STAGE_THROUGHPUT = Histogram('spcut_stage_throughput_bytes_per_second', 'Throughput per pipeline stage.',
+                             THROUGHPUT_BUCKETS)
+CHILD_CPU_SECONDS = Histogram('spcut_child_cpu_seconds', 'User+system CPU of child processes per stage.')
+CHILD_MAX_RSS = Histogram('spcut_child_max_rss_bytes', 'Peak RSS of child processes per stage.', RSS_BUCKETS)
+
+
+class Popen(subprocess.Popen):
+    # reaps with wait4 so the child's rusage is kept on the object
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, sts, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, sts
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.failed = False
+        self.cpu_seconds = None
+        self.max_rss = None
+
+    def add_child(self, process):
+        rusage = process.rusage
+        if rusage is None:
+            return
+        self.cpu_seconds = (self.cpu_seconds or 0.0) + rusage.ru_utime + rusage.ru_stime
+        # ru_maxrss is in KiB on Linux
+        self.max_rss = max(self.max_rss or 0, rusage.ru_maxrss * 1024)
+
+
+@contextmanager
+def stage(name):
+    current = Stage(name)
+    started = time.time()
+    status = 'error'
+    try:
+        yield current
+        status = 'error' if current.failed else 'ok'
+    finally:
+        seconds = time.time() - started
+        STAGE_SECONDS.observe(seconds, stage=name, status=status)
+        record = {'name': name, 'status': status, 'seconds': seconds}
+        if current.bytes:
+            STAGE_BYTES.inc(current.bytes, stage=name)
+            STAGE_THROUGHPUT.observe(current.bytes / max(seconds, 1e-6), stage=name)
+            record['bytes'] = current.bytes
+            record['bytes_per_sec'] = current.bytes / max(seconds, 1e-6)
+        if current.cpu_seconds is not None:
+            CHILD_CPU_SECONDS.observe(current.cpu_seconds, stage=name)
+            CHILD_MAX_RSS.observe(current.max_rss, stage=name)
+            record['child_cpu_seconds'] = current.cpu_seconds
+            record['child_max_rss_bytes'] = current.max_rss
+        jobs.record_stage(record)
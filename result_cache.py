@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import config
+import downloader
+import storage
+
+logger = logging.getLogger(__name__)
+
+
+def url_identity(url):
+    try:
+        info = downloader.probe(url)
+    except downloader.DownloadError as e:
+        logger.warning(f"cache probe failed: {e}")
+        return None
+    return info_identity(info)
+
+
+def info_identity(info):
+    # strong ETag + length identify the content without downloading it
+    etag = info['etag']
+    if not etag or etag.startswith('W/') or info['size'] is None:
+        return None
+    etag = etag.strip('"')
+    return f"etag:{etag}:{info['size']}"
+
+
+def file_identity(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(config.MB), b''):
+            digest.update(chunk)
+    return f"sha256:{digest.hexdigest()}"
+
+
+def make_key(endpoint, identities, args):
+    payload = json.dumps({'endpoint': endpoint, 'inputs': identities, 'args': args}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, path, max_entries, max_bytes, ttl):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        'key TEXT PRIMARY KEY, objects TEXT NOT NULL, expires INTEGER NOT NULL, '
+                        'size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+        self.db.commit()
+
+    def lookup(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT objects, expires, created FROM results WHERE key = ?', (key,)).fetchone()
+            if row and row[2] < time.time() - self.ttl:
+                self._delete(key)
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+
+        objects, expires = json.loads(row[0]), row[1]
+        # the output key may have been overwritten or expired out of the bucket since
+        for bucket, s3_key, etag in objects.values():
+            head = storage.head_object(bucket, s3_key)
+            if head is None or head['ETag'] != etag:
+                logger.info(f"cache entry {key} is stale: s3://{bucket}/{s3_key} changed")
+                with self.lock:
+                    self._delete(key)
+                    self.misses += 1
+                return None
+
+        with self.lock:
+            self.hits += 1
+            self.db.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+        logger.info(f"cache hit {key}")
+        return {name: storage.presign(bucket, s3_key, expires) for name, (bucket, s3_key, etag) in objects.items()}
+
+    def store(self, key, outputs, expires):
+        # outputs: {result name: (bucket, key)}
+        objects = {}
+        size = 0
+        for name, (bucket, s3_key) in outputs.items():
+            head = storage.head_object(bucket, s3_key)
+            if head is None:
+                return
+            objects[name] = (bucket, s3_key, head['ETag'])
+            size += head['ContentLength']
+
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, json.dumps(objects), expires, size, now, now))
+            self._evict()
+            self.db.commit()
+
+    def _delete(self, key):
+        self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+        self.db.commit()
+
+    def _evict(self):
+        self.db.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl,))
+        entries, total = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+        if entries <= self.max_entries and total <= self.max_bytes:
+            return
+        # least recently used first; only the index entry goes, objects age out via bucket lifecycle
+        for key, size in self.db.execute('SELECT key, size FROM results ORDER BY last_access').fetchall():
+            if entries <= self.max_entries and total <= self.max_bytes:
+                break
+            self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+            entries -= 1
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            entries, total = self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results').fetchone()
+            return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': total}
+
+
+cache = ResultCache(os.path.join(config.STATE_DIR, 'results.db'), config.RESULT_CACHE_MAX_ENTRIES,
+                    config.RESULT_CACHE_MAX_BYTES, config.RESULT_CACHE_TTL)
@@ -0,0 +1,143 @@
+import codecs
+import collections
+import logging
+import os
+import re
+import subprocess
+import time
+
+import config
+import jobs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# longest partial line kept while waiting for its end, so a tool that never prints a newline
+# can't grow the buffer
+MAX_LINE = 4096
+
+# ./spatial prints "%5.1f%%"; ffmpeg prints "frame=  123 ... time=00:00:05.00" (or key=value
+# lines with -progress pipe:1)
+PERCENT = re.compile(r'(\d{1,3}(?:\.\d+)?)%')
+FRAME = re.compile(r'frame=\s*(\d+)')
+TIME = re.compile(r'(?:^|\s)time=\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+OUT_TIME_US = re.compile(r'^out_time_us=(\d+)')
+
+
+class Completed:
+    def __init__(self, args, returncode, lines, rusage):
+        self.args = args
+        self.returncode = returncode
+        self.lines = lines
+        self.rusage = rusage
+
+    @property
+    def output(self):
+        return '\n'.join(self.lines)
+
+
+class Progress:
+    def __init__(self, duration=None, enabled=True):
+        self.duration = duration
+        self.enabled = enabled
+        self.started = time.time()
+        self.published = 0
+        self.state = {}
+
+    def parse(self, line):
+        changed = False
+        match = FRAME.search(line)
+        if match:
+            self.state['frame'] = int(match.group(1))
+            changed = True
+        seconds = None
+        match = OUT_TIME_US.match(line)
+        if match:
+            seconds = int(match.group(1)) / 1e6
+        else:
+            match = TIME.search(line)
+            if match:
+                seconds = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+        if seconds is not None and self.duration:
+            self.state['percent'] = round(min(100.0, 100.0 * seconds / self.duration), 1)
+            changed = True
+        elif seconds is None and not self.duration:
+            # with a duration the percent comes from time=; ffmpeg's closing stats are full of % signs
+            match = PERCENT.search(line)
+            if match and float(match.group(1)) <= 100:
+                self.state['percent'] = float(match.group(1))
+                changed = True
+        return changed
+
+    def snapshot(self):
+        data = dict(self.state)
+        elapsed = time.time() - self.started
+        data['elapsed'] = round(elapsed, 1)
+        percent = data.get('percent')
+        if percent:
+            data['eta'] = round(elapsed * (100 - percent) / percent, 1)
+        return data
+
+    def publish(self, force=False):
+        if not self.enabled:
+            return
+        now = time.time()
+        if force or now - self.published >= config.PROGRESS_INTERVAL:
+            self.published = now
+            jobs.progress(self.snapshot())
+
+
+def run(args, shell=False, input=None, duration=None, max_lines=None, publish=True):
+    # runs a child with stdout and stderr merged, keeping only the last max_lines lines and
+    # publishing parsed progress to the current job as it goes (unless publish is False, for work
+    # running beside the job's main step). The child gets its own process group so cancelling the
+    # job also reaches whatever a shell started
+    jobs.check_cancelled()
+    lines = collections.deque(maxlen=max_lines or config.PROCESS_OUTPUT_LINES)
+    progress = Progress(duration, publish)
+    process = metrics.Popen(args, shell=shell, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+    try:
+        with jobs.track(process):
+            _read_output(process, input, lines, progress)
+    except BaseException:
+        jobs.kill_group(process)
+        process.wait()
+        raise
+    finally:
+        process.stdout.close()
+
+    if progress.state:
+        progress.publish(force=True)
+    jobs.check_cancelled()
+    return Completed(args, process.returncode, list(lines), process.rusage)
+
+
+def _read_output(process, input, lines, progress):
+    if input is not None:
+        try:
+            process.stdin.write(input.encode())
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+    fd = process.stdout.fileno()
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        # progress bars redraw with \r, so treat it as a line end too
+        parts = re.split(r'[\r\n]', partial + decoder.decode(chunk))
+        partial = parts.pop()[-MAX_LINE:]
+        for line in parts:
+            if not line.strip():
+                continue
+            lines.append(line)
+            if progress.parse(line):
+                progress.publish()
+    if partial.strip():
+        lines.append(partial)
+        progress.parse(partial)
+    process.wait()
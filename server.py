@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# Production entry point: gunicorn with threaded workers instead of the Flask dev server.
+#
+#   python server.py        # SPCUT_SERVER_BIND, SPCUT_SERVER_WORKERS, SPCUT_SERVER_THREADS
+#
+# Libraries that are slow to import are loaded once in the master before it forks. The app itself
+# is imported in each worker, since its job threads and boto3 clients don't survive a fork. On
+# SIGTERM a worker stops taking new jobs (/readyz turns 503) but keeps answering status and event
+# requests until its jobs finish or SPCUT_DRAIN_TIMEOUT passes, then exits.
+import signal
+import threading
+
+import boto3  # noqa: F401 - preloaded before fork
+import botocore.session  # noqa: F401
+import flask  # noqa: F401
+import requests  # noqa: F401
+from gunicorn.app.base import BaseApplication
+
+import config
+
+
+def post_worker_init(worker):
+    import app
+
+    def drain_then_exit(sig, frame):
+        def run():
+            app.drain()
+            worker.handle_exit(sig, frame)
+        threading.Thread(target=run, name='drain', daemon=True).start()
+
+    # replaces gunicorn's handler, which would stop serving straight away
+    signal.signal(signal.SIGTERM, drain_then_exit)
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import app
+        app.warm()
+        return app.app
+
+
+def main():
+    Server({
+        'bind': config.SERVER_BIND,
+        'workers': config.SERVER_WORKERS,
+        'worker_class': 'gthread',
+        'threads': config.SERVER_THREADS,
+        # the master waits this long after SIGTERM before killing a worker
+        'graceful_timeout': config.DRAIN_TIMEOUT + 30,
+        'post_worker_init': post_worker_init,
+        'accesslog': '-',
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
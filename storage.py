@@ -0,0 +1,213 @@
+import calendar
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+import config
+import jobs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_lock = threading.Lock()
+_stats = {'uploads': 0, 'bytes': 0, 'seconds': 0.0}
+
+
+def get_client():
+    global _client
+    with _lock:
+        if _client is None:
+            session = boto3.session.Session()
+            _client = session.client(
+                's3',
+                endpoint_url=config.S3_ENDPOINT_URL or None,
+                config=Config(max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                              retries={'max_attempts': 5, 'mode': 'adaptive'}),
+            )
+        return _client
+
+
+def transfer_config():
+    return TransferConfig(
+        multipart_threshold=config.S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=config.S3_PART_SIZE,
+        max_concurrency=config.S3_UPLOAD_CONCURRENCY,
+    )
+
+
+def signed_until(query):
+    # expiry (unix time) of a presigned S3 URL's signature, SigV4 or V2; None if it carries none
+    params = {k.lower(): v[0] for k, v in urllib.parse.parse_qs(query).items()}
+    try:
+        if 'x-amz-signature' in params:
+            signed = calendar.timegm(time.strptime(params['x-amz-date'], '%Y%m%dT%H%M%SZ'))
+            return signed + int(params['x-amz-expires'])
+        if 'signature' in params:
+            return int(params['expires'])
+    except (KeyError, ValueError):
+        pass
+    return None
+
+
+def parse_url(url):
+    # (bucket, key) when url is an unexpired presigned URL into one of our own buckets; else None.
+    # The signature itself is only checked by S3, so callers must have had the URL accepted (the
+    # probe's ranged GET) before fetching the object with our own credentials
+    parsed = urllib.parse.urlparse(url)
+    expires = signed_until(parsed.query)
+    if expires is None or expires <= time.time():
+        return None
+    host = (parsed.hostname or '').lower()
+    path = urllib.parse.unquote(parsed.path).lstrip('/')
+    endpoint = urllib.parse.urlparse(config.S3_ENDPOINT_URL) if config.S3_ENDPOINT_URL else None
+
+    if endpoint is not None and parsed.netloc == endpoint.netloc:
+        bucket, _, key = path.partition('/')
+    elif host.endswith('.amazonaws.com') and (host.startswith('s3.') or host.startswith('s3-')):
+        bucket, _, key = path.partition('/')
+    elif host.endswith('.amazonaws.com') and '.s3' in host:
+        bucket, key = host[:host.index('.s3')], path
+    else:
+        return None
+    if bucket not in config.S3_DIRECT_BUCKETS or not key:
+        return None
+    return bucket, key
+
+
+def _transfer(method, *args):
+    # an s3transfer upload/download that is cancelled as soon as the job is: the transfer manager
+    # aborts a multipart upload it cancels, so no parts are left behind in the bucket
+    check = jobs.cancel_check()
+    with create_transfer_manager(get_client(), transfer_config()) as manager:
+        future = getattr(manager, method)(*args)
+        while not future.done():
+            time.sleep(0.1)
+            try:
+                check()
+            except jobs.Cancelled:
+                future.cancel()
+                raise
+        return future.result()
+
+
+def download_file(bucket, key, path):
+    # ranged GETs in parallel through the pooled client, sized like uploads
+    _transfer('download', bucket, key, path)
+
+
+def upload_file(path, bucket, key):
+    size = os.path.getsize(path)
+    started = time.time()
+    with metrics.stage('upload') as stage:
+        _transfer('upload', path, bucket, key)
+        stage.bytes = size
+    elapsed = max(time.time() - started, 1e-6)
+
+    with _lock:
+        _stats['uploads'] += 1
+        _stats['bytes'] += size
+        _stats['seconds'] += elapsed
+    jobs.record('upload_bytes_per_sec', size / elapsed)
+    logger.info(f"uploaded {path} to s3://{bucket}/{key}: {size} bytes in {elapsed:.2f}s "
+                f"({size / elapsed / config.MB:.1f} MB/s)")
+    return {'bytes': size, 'seconds': elapsed, 'bytes_per_sec': size / elapsed}
+
+
+def _read_part(stream, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def upload_stream(stream, bucket, key, commit_check=None):
+    # multipart upload of a pipe as it is produced; memory is bounded to concurrency + 1 parts.
+    # commit_check runs after EOF and aborts the upload if the producer failed
+    with metrics.stage('upload') as stage:
+        result = _upload_stream(stream, bucket, key, commit_check)
+        stage.bytes = result['bytes']
+    return result
+
+
+def _upload_stream(stream, bucket, key, commit_check):
+    client = get_client()
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    in_flight = threading.BoundedSemaphore(config.S3_UPLOAD_CONCURRENCY)
+    started = time.time()
+    size = 0
+    futures = []
+
+    def put_part(number, data):
+        try:
+            return client.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)['ETag']
+        finally:
+            in_flight.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=config.S3_UPLOAD_CONCURRENCY) as pool:
+            while True:
+                data = _read_part(stream, config.S3_PART_SIZE)
+                jobs.check_cancelled()
+                if not data and futures:
+                    break
+                in_flight.acquire()
+                futures.append(pool.submit(put_part, len(futures) + 1, data))
+                size += len(data)
+                if not data:
+                    break
+        parts = [{'PartNumber': i + 1, 'ETag': future.result()} for i, future in enumerate(futures)]
+        if commit_check is not None and not commit_check():
+            raise RuntimeError(f"producer failed, discarding upload of s3://{bucket}/{key}")
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except BaseException:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    elapsed = max(time.time() - started, 1e-6)
+    with _lock:
+        _stats['uploads'] += 1
+        _stats['bytes'] += size
+        _stats['seconds'] += elapsed
+    logger.info(f"streamed to s3://{bucket}/{key}: {size} bytes in {len(futures)} parts over {elapsed:.2f}s")
+    return {'bytes': size, 'seconds': elapsed, 'bytes_per_sec': size / elapsed}
+
+
+def upload_files(uploads):
+    # uploads: [(path, bucket, key), ...], run side by side on the shared client
+    with ThreadPoolExecutor(max_workers=max(1, len(uploads))) as pool:
+        return list(pool.map(jobs.bind(lambda item: upload_file(*item)), uploads))
+
+
+def presign(bucket, key, expires):
+    with metrics.stage('presign'):
+        return get_client().generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=expires)
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    result['bytes_per_sec'] = result['bytes'] / result['seconds'] if result['seconds'] else 0.0
+    return result
+
+
+def head_object(bucket, key):
+    try:
+        return get_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
@@ -0,0 +1,454 @@
+import collections
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, wait
+
+import config
+import jobs
+import metrics
+import runner
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_ENCODE_ARGS = ['-c:v', 'libx265', '-preset', 'ultrafast', '-crf', '18', '-vf', 'format=yuv420p',
+                       '-profile:v', 'main', '-level', '5.1']
+# what SEGMENT_ENCODE_ARGS produce; ffprobe reports HEVC levels as level * 30
+TARGET_STREAM = {'codec_name': 'hevc', 'pix_fmt': 'yuv420p', 'profile': 'Main'}
+TARGET_LEVEL = 153
+
+_probe_cache = collections.OrderedDict()
+_probe_lock = threading.Lock()
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def run_ffmpeg(args, stage_name, input_file=None):
+    with metrics.stage(stage_name) as stage:
+        process = metrics.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, start_new_session=True)
+        with jobs.track(process):
+            stdout, stderr = process.communicate()
+        stage.add_child(process)
+        jobs.check_cancelled()
+        if input_file:
+            stage.bytes = os.path.getsize(input_file)
+        if process.returncode != 0:
+            raise TranscodeError(f"{args[0]} failed ({process.returncode}): {stderr[-2000:]}")
+    return stdout
+
+
+def run_tool(args, stage_name, input_file=None, publish=True):
+    # run_ffmpeg through runner: output kept to its last lines and progress published to the job
+    with metrics.stage(stage_name) as stage:
+        process = runner.run(args, publish=publish)
+        stage.add_child(process)
+        if input_file:
+            stage.bytes = os.path.getsize(input_file)
+        if process.returncode != 0:
+            raise TranscodeError(f"{args[0]} failed ({process.returncode}): {process.output[-2000:]}")
+    return process
+
+
+def keyframe_times(input_file):
+    output = run_ffmpeg(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+                         '-of', 'csv=p=0', input_file], 'ffprobe')
+    times = []
+    for line in output.splitlines():
+        pts, _, flags = line.partition(',')
+        if 'K' in flags and pts not in ('', 'N/A'):
+            times.append(float(pts))
+    return sorted(times)
+
+
+def probe_video(input_file):
+    # first video stream's format, cached by path, size and mtime so repeat lookups don't rerun ffprobe
+    st = os.stat(input_file)
+    key = (os.path.abspath(input_file), st.st_size, st.st_mtime_ns)
+    with _probe_lock:
+        if key in _probe_cache:
+            _probe_cache.move_to_end(key)
+            return _probe_cache[key]
+
+    output = run_ffmpeg(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                         'stream=codec_name,codec_tag_string,pix_fmt,profile,level', '-of', 'json', input_file],
+                        'ffprobe')
+    streams = json.loads(output or '{}').get('streams') or []
+    info = streams[0] if streams else None
+
+    with _probe_lock:
+        _probe_cache[key] = info
+        while len(_probe_cache) > config.PROBE_CACHE_SIZE:
+            _probe_cache.popitem(last=False)
+    return info
+
+
+def can_remux(info):
+    if info is None or any(info.get(k) != v for k, v in TARGET_STREAM.items()):
+        return False
+    return 0 < int(info.get('level') or 0) <= TARGET_LEVEL
+
+
+def remux(input_file, output_file):
+    started = time.time()
+    run_ffmpeg(['ffmpeg', '-y', '-i', input_file, '-map', '0:v:0', '-map', '0:a?', '-c', 'copy', '-tag:v', 'hvc1',
+                '-movflags', '+faststart', output_file], 'ffmpeg_remux', input_file)
+    timing = {'segment': 'remux', 'seconds': time.time() - started, 'bytes': os.path.getsize(output_file)}
+    logger.info(f"{input_file} is already {TARGET_STREAM['codec_name']} {TARGET_STREAM['pix_fmt']}, "
+                f"remuxed in {timing['seconds']:.2f}s")
+    return timing
+
+
+def preview(inputs, output_file):
+    # short, downscaled H.264 proxy of the first seconds; two inputs (left, right) go side by side.
+    # It runs beside the full encode on the same job, so it leaves the job's progress to that
+    args = ['ffmpeg', '-y']
+    for input_file in inputs:
+        args += ['-t', str(config.PREVIEW_SECONDS), '-i', input_file]
+    scaled = ''.join(f"[{i}:v]scale=-2:'min(ih,{config.PREVIEW_HEIGHT})'[v{i}];" for i in range(len(inputs)))
+    joined = ''.join(f'[v{i}]' for i in range(len(inputs)))
+    graph = scaled + (f'{joined}hstack=inputs={len(inputs)}[out]' if len(inputs) > 1 else f'{joined}null[out]')
+    run_tool(args + ['-filter_complex', graph, '-map', '[out]', '-map', '0:a?', '-c:v', 'libx264',
+                     '-preset', 'veryfast', '-b:v', config.PREVIEW_BITRATE, '-maxrate', config.PREVIEW_BITRATE,
+                     '-bufsize', config.PREVIEW_BITRATE, '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '96k',
+                     '-movflags', '+faststart', output_file], 'ffmpeg_preview', inputs[0], publish=False)
+    return output_file
+
+
+def segment_cuts(keyframes, segment_seconds):
+    # first keyframe at or after each multiple of segment_seconds, so every segment starts on a keyframe
+    cuts = []
+    target = segment_seconds
+    for t in keyframes:
+        if t >= target:
+            cuts.append(t)
+            target = t + segment_seconds
+    return cuts
+
+
+def common_cuts(left_keyframes, right_keyframes, chunk_seconds):
+    # cut points that are keyframes in both eyes, so each chunk pair covers exactly the same frames
+    right = {round(t, 3) for t in right_keyframes}
+    return segment_cuts([t for t in left_keyframes if round(t, 3) in right], chunk_seconds)
+
+
+def split_at(input_file, cuts, pattern):
+    # stream-copies the video track into one file per chunk; returns the chunk files in order
+    run_tool(['ffmpeg', '-y', '-i', input_file, '-map', '0:v:0', '-c', 'copy', '-f', 'segment', '-segment_format',
+              'mov', '-segment_times', ','.join(f'{t:.6f}' for t in cuts), '-reset_timestamps', '1', pattern],
+             'ffmpeg_segment', input_file)
+    return sorted(glob.glob(pattern.replace('%05d', '[0-9]' * 5)))
+
+
+def concat(chunks, audio_source, output_file):
+    # chunks joined without re-encoding, timestamps continuing across the joins; audio in one piece from
+    # audio_source so it has no seams
+    concat_list = output_file + '.txt'
+    with open(concat_list, 'w') as f:
+        for chunk in chunks:
+            f.write(f"file '{os.path.abspath(chunk)}'\n")
+    try:
+        run_tool(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list, '-i', audio_source,
+                  '-map', '0:v', '-map', '1:a?', '-map_metadata', '0', '-c', 'copy', '-tag:v', 'hvc1',
+                  '-movflags', '+faststart', output_file], 'ffmpeg_concat', chunks[0])
+    finally:
+        os.remove(concat_list)
+
+
+def stream_stats(input_file):
+    # frame count and duration of the first video stream. key=value lines rather than JSON, since
+    # runner hands back stdout and stderr interleaved
+    process = run_tool(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets', '-show_entries',
+                        'stream=nb_read_packets,duration', '-of', 'default=noprint_wrappers=1', input_file], 'ffprobe')
+    stream = dict(line.partition('=')[::2] for line in process.lines if '=' in line)
+    duration = stream.get('duration', 'N/A')
+    return {'frames': int(stream.get('nb_read_packets') or 0),
+            'duration': 0.0 if duration == 'N/A' else float(duration)}
+
+
+def _boxes(f, start, end):
+    # (type, payload start, end) of the ISO BMFF boxes between start and end
+    pos = start
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size, header = struct.unpack('>Q', f.read(8))[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            return
+        yield kind.decode('latin-1'), pos + header, min(pos + size, end)
+        pos += size
+
+
+def _find(f, box, *kinds):
+    # the box at a path of child types under box, or None
+    for kind in kinds:
+        box = next((b for b in _boxes(f, box[1], box[2]) if b[0] == kind), None)
+        if box is None:
+            return None
+    return box
+
+
+def sample_entry(input_file):
+    # format of the first video track's sample entry and the boxes inside it (hvcC, and for MV-HEVC
+    # lhvC and vexu with the stereo layout); None if the file has no video track
+    with open(input_file, 'rb') as f:
+        moov = _find(f, ('', 0, os.fstat(f.fileno()).st_size), 'moov')
+        for trak in _boxes(f, moov[1], moov[2]) if moov else ():
+            if trak[0] != 'trak' or _find(f, trak, 'mdia', 'minf', 'vmhd') is None:
+                continue
+            stsd = _find(f, trak, 'mdia', 'minf', 'stbl', 'stsd')
+            # stsd has version/flags and an entry count before its entries; a visual sample entry
+            # has 78 bytes of fields before its child boxes
+            entry = next(_boxes(f, stsd[1] + 8, stsd[2]), None) if stsd else None
+            if entry is not None:
+                return entry[0], sorted({b[0] for b in _boxes(f, entry[1] + 78, entry[2])})
+    return None
+
+
+def same_timeline(expected, actual):
+    # equal frame counts and durations within two frames
+    if not expected['frames'] or expected['frames'] != actual['frames']:
+        return False
+    return abs(expected['duration'] - actual['duration']) <= 2 * expected['duration'] / expected['frames']
+
+
+class TranscodeEngine:
+    # one process-wide pool of ffmpeg slots; segments from concurrent jobs are taken round-robin
+    def __init__(self, cpu_budget, threads_per_segment):
+        self.threads = max(1, threads_per_segment)
+        self.slots = max(1, cpu_budget // self.threads)
+        self.queues = collections.OrderedDict()
+        self.cond = threading.Condition()
+        self.started = False
+
+    def _start(self):
+        for i in range(self.slots):
+            threading.Thread(target=self._worker, name=f'transcode-{i}', daemon=True).start()
+        self.started = True
+        logger.info(f"transcode engine started: {self.slots} slots x {self.threads} threads")
+
+    def submit(self, owner, func, calls):
+        futures = []
+        with self.cond:
+            if not self.started:
+                self._start()
+            queue = self.queues.setdefault(owner, collections.deque())
+            for args in calls:
+                future = Future()
+                queue.append((future, func, args))
+                futures.append(future)
+            self.cond.notify_all()
+        return futures
+
+    def _take(self):
+        # round-robin across owners, FIFO within an owner
+        with self.cond:
+            while not self.queues:
+                self.cond.wait()
+            owner, queue = self.queues.popitem(last=False)
+            task = queue.popleft()
+            if queue:
+                self.queues[owner] = queue
+            return task
+
+    def _worker(self):
+        while True:
+            future, func, args = self._take()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+engine = TranscodeEngine(config.TRANSCODE_CPU_BUDGET or os.cpu_count() or 1, config.TRANSCODE_THREADS)
+
+
+def encode_segment(segment_file, output_segment):
+    started = time.time()
+    run_ffmpeg(['ffmpeg', '-y', '-i', segment_file, *SEGMENT_ENCODE_ARGS,
+                '-threads', str(engine.threads), '-x265-params', f'pools={engine.threads}',
+                '-an', output_segment], 'ffmpeg_encode', segment_file)
+    timing = {'segment': os.path.basename(segment_file), 'seconds': time.time() - started,
+              'bytes': os.path.getsize(output_segment)}
+    logger.info(f"segment {timing['segment']} encoded in {timing['seconds']:.2f}s")
+    return timing
+
+
+def source_key(input_file):
+    # identifies the source by its whole content (as result_cache.file_identity does) and the encode
+    # settings, so a resubmission downloaded under another name finds the same checkpoint and a
+    # different clip that merely starts and ends alike never does
+    digest = hashlib.sha256(json.dumps([SEGMENT_ENCODE_ARGS, config.SEGMENT_SECONDS]).encode())
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(config.MB), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:32]
+
+
+class Manifest:
+    # which segments of a checkpointed transcode are already encoded; rewritten after each one
+    def __init__(self, workdir):
+        self.path = os.path.join(workdir, 'manifest.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {'segments': None, 'done': {}}
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.data)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(data)
+        os.replace(self.path + '.tmp', self.path)
+
+    def segmented(self, workdir):
+        segments = self.data['segments']
+        return segments is not None and all(os.path.exists(os.path.join(workdir, s)) for s in segments)
+
+    def encoded(self, name, output):
+        timing = self.data['done'].get(name)
+        return timing is not None and os.path.exists(output) and os.path.getsize(output) == timing['bytes']
+
+    def done(self, name, timing):
+        with self.lock:
+            self.data['done'][name] = timing
+        self.save()
+
+
+def claim_checkpoint(input_file):
+    # the source's checkpoint directory, locked for this transcode; None if another transcode of
+    # the same source holds it
+    workdir = os.path.join(config.CHECKPOINT_DIR, source_key(input_file))
+    os.makedirs(workdir, exist_ok=True)
+    lock = open(os.path.join(workdir, 'lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None, None
+    return workdir, lock
+
+
+def sweep_checkpoints():
+    # checkpoints of transcodes that failed and were never resubmitted
+    if not os.path.isdir(config.CHECKPOINT_DIR):
+        return
+    cutoff = time.time() - config.CHECKPOINT_TTL
+    for name in os.listdir(config.CHECKPOINT_DIR):
+        workdir = os.path.join(config.CHECKPOINT_DIR, name)
+        manifest = os.path.join(workdir, 'manifest.json')
+        try:
+            if os.path.getmtime(manifest if os.path.exists(manifest) else workdir) >= cutoff:
+                continue
+            with open(os.path.join(workdir, 'lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(workdir, ignore_errors=True)
+        except OSError:
+            continue
+        logger.info(f"removed stale transcode checkpoint {workdir}")
+
+
+def encode_checkpointed(segment_file, output_segment, manifest):
+    # transient encoder failures are retried; a cancelled job is not
+    name = os.path.basename(segment_file)
+    for attempt in range(config.SEGMENT_RETRIES + 1):
+        try:
+            timing = encode_segment(segment_file, output_segment)
+            break
+        except TranscodeError as e:
+            if attempt == config.SEGMENT_RETRIES:
+                raise
+            logger.warning(f"segment {name} failed (attempt {attempt + 1}), retrying: {e}")
+            time.sleep(min(2 ** attempt, 10))
+    timing['attempts'] = attempt + 1
+    manifest.done(name, timing)
+    return timing
+
+
+def transcode(input_file, output_file, request_id, owner=None):
+    if config.TRANSCODE_REMUX:
+        info = probe_video(input_file)
+        if can_remux(info):
+            return [remux(input_file, output_file)]
+        logger.info(f"{input_file} needs a full transcode: {info}")
+
+    sweep_checkpoints()
+    workdir, lock = claim_checkpoint(input_file)
+    if workdir is None:
+        logger.info(f"{input_file} is already being transcoded, encoding without a checkpoint")
+        workdir = tempfile.mkdtemp(prefix=f'transcode_{request_id}_', dir='.')
+    manifest = Manifest(workdir)
+    keep = False
+    try:
+        if not manifest.segmented(workdir):
+            for stale in glob.glob(os.path.join(workdir, '*.mkv')):
+                os.remove(stale)
+            cuts = segment_cuts(keyframe_times(input_file), config.SEGMENT_SECONDS)
+            split = ['-segment_times', ','.join(f'{t:.6f}' for t in cuts)] if cuts else ['-segment_time', '86400']
+            run_ffmpeg(['ffmpeg', '-y', '-i', input_file, '-map', '0:v:0', '-c', 'copy', '-f', 'segment', *split,
+                        '-reset_timestamps', '1', os.path.join(workdir, 'segment_%05d.mkv')], 'ffmpeg_segment',
+                       input_file)
+            manifest.data = {'segments': sorted(os.path.basename(p) for p in
+                                                glob.glob(os.path.join(workdir, 'segment_*.mkv'))), 'done': {}}
+            manifest.save()
+
+        calls = [(os.path.join(workdir, segment), os.path.join(workdir, 'encoded_' + segment))
+                 for segment in manifest.data['segments']]
+        pending = [(segment, encoded, manifest) for segment, encoded in calls
+                   if not manifest.encoded(os.path.basename(segment), encoded)]
+        if len(pending) < len(calls):
+            logger.info(f"resuming {input_file} from checkpoint: {len(calls) - len(pending)} of {len(calls)} "
+                        f"segments already encoded")
+        jobs.record('segments_resumed', len(calls) - len(pending))
+        futures = engine.submit(owner or request_id, jobs.bind(encode_checkpointed), pending)
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            # segments already running still write into workdir; it can't be released under them
+            wait(futures)
+            raise
+        timings = [manifest.data['done'][os.path.basename(segment)] for segment, _ in calls]
+
+        concat_list = os.path.join(workdir, 'concat.txt')
+        with open(concat_list, 'w') as f:
+            for _, encoded in calls:
+                f.write(f"file '{os.path.abspath(encoded)}'\n")
+
+        # video from the encoded segments, audio in one pass from the source so it has no seams
+        run_ffmpeg(['ffmpeg', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list, '-i', input_file,
+                    '-map', '0:v', '-map', '1:a?', '-c:v', 'copy', '-tag:v', 'hvc1', '-c:a', 'aac', '-b:a', '320k',
+                    '-movflags', '+faststart', output_file], 'ffmpeg_concat', input_file)
+        return timings
+    except jobs.Cancelled:
+        raise
+    except Exception:
+        # what was encoded stays for the next attempt at this source
+        keep = lock is not None
+        raise
+    finally:
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if lock is not None:
+            lock.close()
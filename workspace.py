@@ -0,0 +1,178 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_reserved = {}
+_live = set()
+# called as reclaim(root, need) when no root has room for a job; each frees what it can on root's
+# filesystem (the media cache registers its eviction here)
+reclaimers = []
+
+
+class InsufficientSpace(Exception):
+    pass
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class DiskMonitor:
+    # samples the size of a scratch directory to find its peak disk usage
+    def __init__(self, path, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, dir_size(self.path))
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.peak
+
+
+class Workspace:
+    def __init__(self, path, root, reserved):
+        self.dir = path
+        self.root = root
+        self.reserved = reserved
+        self.closed = False
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def close(self):
+        with _lock:
+            if self.closed:
+                return
+            self.closed = True
+            _reserved[self.root] -= self.reserved
+            _live.discard(self.dir)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        logger.info(f"workspace {self.dir} removed")
+
+
+def _roots():
+    roots = []
+    if config.TMPFS_DIR and os.path.isdir(os.path.dirname(config.TMPFS_DIR.rstrip('/')) or '/'):
+        roots.append((config.TMPFS_DIR, True))
+    roots.append((config.WORKSPACE_DIR, False))
+    return roots
+
+
+def admit(job_kind, input_bytes):
+    # reserve space for the whole job up front so a node never fills its disk mid-encode;
+    # small jobs go to RAM-backed tmpfs, large ones to disk
+    if input_bytes is None:
+        input_bytes = config.WORKSPACE_DEFAULT_INPUT_BYTES
+    need = int(input_bytes * config.WORKSPACE_EXPANSION.get(job_kind, 3.0))
+
+    ws, short = _reserve(job_kind, need)
+    if ws is None and short > 0 and reclaimers:
+        # what the disk root lacks may be held by caches nobody is using right now
+        for reclaim in reclaimers:
+            reclaim(config.WORKSPACE_DIR, short)
+        ws, _ = _reserve(job_kind, need)
+    if ws is None:
+        raise InsufficientSpace(f"no workspace root has {need / config.MB:.0f} MB free for a {job_kind} job")
+    return ws
+
+
+def _reserve(job_kind, need):
+    # a Workspace on the first root with room, else None and how many bytes the disk root is short
+    short = 0
+    with _lock:
+        for root, tmpfs in _roots():
+            if tmpfs and need > config.TMPFS_MAX_JOB_BYTES:
+                continue
+            try:
+                os.makedirs(root, exist_ok=True)
+                free = shutil.disk_usage(root).free
+            except OSError as e:
+                logger.warning(f"workspace root {root} unavailable: {e}")
+                continue
+            reserved = _reserved.get(root, 0)
+            available = free - reserved - config.WORKSPACE_MIN_FREE
+            if tmpfs:
+                available = min(available, config.TMPFS_BUDGET - reserved)
+            if available < need:
+                if not tmpfs:
+                    short = need - available
+                continue
+            _reserved[root] = reserved + need
+            # the pid in the name lets sweep() tell a crashed process's workspaces from live ones
+            path = tempfile.mkdtemp(prefix=f'{job_kind}_{os.getpid()}_', dir=root)
+            _live.add(path)
+            logger.info(f"workspace {path}: reserved {need / config.MB:.0f} MB")
+            return Workspace(path, root, need), 0
+    return None, short
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep():
+    # removes workspaces whose process is gone, and any of this process's that no job holds
+    removed = 0
+    for root, _ in _roots():
+        try:
+            names = os.listdir(root)
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            parts = name.split('_')
+            if len(parts) < 3 or not parts[1].isdigit() or not os.path.isdir(path):
+                continue
+            pid = int(parts[1])
+            with _lock:
+                live = path in _live
+            if live or (pid != os.getpid() and _alive(pid)):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            logger.info(f"removed orphaned workspace {path}")
+    return removed
+
+
+def _janitor():
+    while True:
+        time.sleep(config.JANITOR_INTERVAL)
+        try:
+            sweep()
+        except Exception:
+            logger.exception("workspace sweep failed")
+
+
+def start_janitor():
+    threading.Thread(target=_janitor, name='workspace-janitor', daemon=True).start()